@@ -0,0 +1,262 @@
+"""
+Batched engine: many replicas of the same maze, advanced at once
+
+Positions and velocities of R replicas of n disks are kept in
+(R, n, 2) arrays. Every replica keeps its own clock within a step,
+and each pass of the loop handles the next event of every replica
+that has one left in the step, so the Python overhead of an event
+is shared by all replicas. Replicas that solve the maze drop out;
+as with ArrayEvents, the exit of every replica is predicted from
+the disks heading down out of an exit cell, so exit times are those
+of the exit itself rather than of the end of a step. The physics is
+that of vectorized.jump_step(), replica by replica, but not its
+rounding: a replica drifts away from the same run made alone by
+about 1e-9 within a few dozen events, and the disks' chaotic motion
+blows that up over a long run, so only the statistics of the two
+can be compared
+"""
+import random
+import numpy as np
+from numpy.random import seed
+from maze import wall_mask
+from initialize import initial_pos, initial_vel
+from simulate import WALL, PAIR, exit_cells
+from vectorized import wall_times, fix_delta, leaving
+
+
+def pair_rows(pos, vel, r, rep, k):
+    """
+    Time before disk k[i] of replica rep[i] hits each
+    disk of the same replica; pair_times() row by row
+    """
+    dx = pos[rep] - pos[rep, k][:, None]
+    dv = vel[rep] - vel[rep, k][:, None]
+    b_ij = dv[..., 0]*dx[..., 0] + dv[..., 1]*dx[..., 1]
+    dv_2 = dv[..., 0]**2 + dv[..., 1]**2
+    upsilon = b_ij**2 - dv_2*(dx[..., 0]**2 + dx[..., 1]**2 - 4*r**2)
+    hit = (b_ij < 0) & (upsilon > 0)
+    times = np.full(b_ij.shape, np.inf)
+    times[hit] = -(b_ij[hit] + np.sqrt(upsilon[hit]))/dv_2[hit]
+    return times
+
+
+class BatchEvents:
+    """
+    ArrayEvents for many replicas: pair times are cached as
+    absolute times in the upper triangle of an (R, n, n) array,
+    and every replica has its own clock; events counts the
+    events handed out to each replica, and exit holds the time
+    each replica solved the maze at (inf until one is found)
+    """
+    def __init__(self, p, v, r, walls, t):
+        self.r = r
+        self.walls = walls
+        self.events = np.zeros(len(p), dtype=np.int64)
+        self.exits = np.array([i for i, _ in exit_cells(walls)], dtype=np.intp)
+        self.exit = np.full(len(p), np.inf)
+        self.cell = np.floor(p).astype(np.intp)
+        self.pairs = np.full(p.shape[:2] + p.shape[1:2], np.inf)
+        self.update(np.arange(len(p)), np.ones(p.shape[:2], dtype=bool), p, v, t)
+
+    def update(self, rows, ks, p, v, t):
+        """
+        Re-predict the pair events of the disks of replicas
+        rows picked by the (len(rows), n) mask ks
+        """
+        i, k = np.nonzero(ks)
+        if not len(k):
+            return 0
+        rep = rows[i]
+        self.cell[rep, k] = np.floor(p[rep, k])
+        times = t[rep][:, None] + pair_rows(p, v, self.r, rep, k)
+        j = np.arange(p.shape[1])[None, :]
+        rep, k = np.broadcast_to(rep[:, None], times.shape), np.broadcast_to(k[:, None], times.shape)
+        up, low = j > k, j < k
+        self.pairs[rep[up], k[up], np.broadcast_to(j, times.shape)[up]] = times[up]
+        self.pairs[rep[low], np.broadcast_to(j, times.shape)[low], k[low]] = times[low]
+        return 0
+
+    def next_event(self, rows, p, v, t):
+        """
+        Find the next event of replicas rows; returns their times
+        from now, and their kinds and the disks or axes involved
+        """
+        m, n = len(rows), p.shape[1]
+        ix = np.arange(m)
+        walls, cross = (x.reshape(m, 2*n) for x in wall_times(p[rows].reshape(-1, 2),
+                                                             v[rows].reshape(-1, 2), self.r,
+                                                             self.walls,
+                                                             self.cell[rows].reshape(-1, 2)))
+        start = self.cell[rows]
+        flat = self.pairs[rows].reshape(m, n*n)
+        p_ix = np.argmin(flat, axis=1)
+        pair = flat[ix, p_ix] - t[rows]
+        while True:
+            w_ix, c_ix = np.argmin(walls, axis=1), np.argmin(cross, axis=1)
+            due = np.flatnonzero(cross[ix, c_ix] < np.minimum(pair, walls[ix, w_ix]))
+            if not len(due):
+                break
+
+            # moved into a new cell; see what walls lie ahead from there
+            rep, k, l = rows[due], c_ix[due]//2, c_ix[due]%2
+            self.cell[rep, k, l] += np.where(v[rep, k, l] > 0, 1, -1)
+            w, c = wall_times(p[rep, k], v[rep, k], self.r, self.walls, self.cell[rep, k])
+            walls[due, 2*k], walls[due, 2*k+1] = w[:, 0], w[:, 1]
+            cross[due, 2*k], cross[due, 2*k+1] = c[:, 0], c[:, 1]
+        wall = walls[ix, w_ix]
+        hit = pair < wall
+        time = np.where(hit, pair, wall)
+        self._find_exit(rows, start, p, v, t, time)
+        self.events[rows] += np.isfinite(time)
+        return (time, np.where(hit, PAIR, WALL),
+                np.where(hit, p_ix//n, w_ix//2), np.where(hit, p_ix%n, w_ix%2))
+
+    def _find_exit(self, rows, start, p, v, t, until):
+        """
+        Look for a disk of each of replicas rows that is all the
+        way out of the exit before its next event, at until from
+        now; start holds the cells of their disks as of now
+        """
+        todo = np.isinf(self.exit[rows])
+        rows, until, start = rows[todo], until[todo], start[todo]
+        cell = self.cell[rows]
+        out = ((leaving(start, self.exits) | leaving(cell, self.exits) | (cell[..., 1] < -1)) &
+               (start[..., 1] >= -1) & (v[rows, :, 1] < 0))
+        if not out.any():
+            return 0
+        times = np.full(out.shape, np.inf)
+        times[out] = np.maximum((p[rows][out][:, 1]+self.r)/-v[rows][out][:, 1], 0)
+        times = times.min(axis=1)
+        found = times <= until
+        self.exit[rows[found]] = t[rows[found]] + times[found]
+        return 0
+
+
+def move_all(p, v, r, walls, rows, step):
+    """
+    move_all() from vectorized for replicas rows, each by its
+    own step; returns which disks fix_delta() had to touch
+    """
+    n = p.shape[1]
+    pos, vel = p[rows].reshape(-1, 2), v[rows].reshape(-1, 2)
+    step = np.repeat(step, n)
+    changed = np.zeros(len(pos), dtype=bool)
+    for l in (0, 1):
+        changed |= fix_delta(pos, vel, r, walls, l)
+        pos[:, l] += vel[:, l]*step
+    p[rows], v[rows] = pos.reshape(-1, n, 2), vel.reshape(-1, n, 2)
+    return changed.reshape(-1, n)
+
+
+def get_velocities(p, v, rows, kind, a, b):
+    """
+    Change velocities after the events of replicas rows
+    """
+    wall = kind == WALL
+    v[rows[wall], a[wall], b[wall]] *= -1
+    rep, a, b = rows[~wall], a[~wall], b[~wall]
+    x_ij = p[rep, b] - p[rep, a]
+    x_ij /= np.sqrt(x_ij[:, 0]**2 + x_ij[:, 1]**2)[:, None]
+    dv = v[rep, b] - v[rep, a]
+    b_ij = (dv[:, 0]*x_ij[:, 0] + dv[:, 1]*x_ij[:, 1])[:, None]
+    v[rep, a] += x_ij*b_ij
+    v[rep, b] -= x_ij*b_ij
+    return v
+
+
+def pull_apart(p, r, rows, a, b):
+    """
+    pull_apart() from vectorized for replicas rows
+    """
+    shift = np.where(p[rows, a] > p[rows, b], r, -r)
+    p[rows, a] += shift
+    p[rows, b] -= shift
+    return p
+
+
+def batch_step(p, v, r, table, walls, t, next_e, event, dt, live):
+    """
+    Run one step of every live replica, jumping from event to event;
+    next_e and event = (kind, a, b) hold the next event of each replica
+    """
+    kind, a, b = event
+    next_t = t + dt
+    now = np.full(len(p), float(t))
+    while True:
+        rows = np.flatnonzero(live & (now + next_e <= next_t))
+        if not len(rows):
+            break
+        now[rows] += next_e[rows]
+        changed = move_all(p, v, r, walls, rows, next_e[rows])
+        v = get_velocities(p, v, rows, kind[rows], a[rows], b[rows])
+        ix = np.arange(len(rows))
+        changed[ix, a[rows]] = True
+        changed[ix, np.where(kind[rows] == PAIR, b[rows], a[rows])] = True
+        table.update(rows, changed, p, v, now)
+        next_e[rows], kind[rows], a[rows], b[rows] = table.next_event(rows, p, v, now)
+
+        # overlapping disks get pulled apart right away
+        # instead of colliding backwards in time
+        while True:
+            rows = rows[(next_e[rows] < 0) & (kind[rows] == PAIR)]
+            if not len(rows):
+                break
+            p = pull_apart(p, r, rows, a[rows], b[rows])
+            pulled = np.zeros((len(rows), p.shape[1]), dtype=bool)
+            pulled[np.arange(len(rows)), a[rows]] = pulled[np.arange(len(rows)), b[rows]] = True
+            table.update(rows, pulled, p, v, now)
+            next_e[rows], kind[rows], a[rows], b[rows] = table.next_event(rows, p, v, now)
+    rows = np.flatnonzero(live)
+    step = next_t - now[rows]
+    table.update(rows, move_all(p, v, r, walls, rows, step), p, v, np.full(len(p), next_t))
+    next_e[rows] -= step
+    return p, v, next_e, (kind, a, b), next_t
+
+
+def run_batch(p, v, r, edges, n_events, dt, stepsize=1, walls=None):
+    """
+    Run the EdMD simulation for R replicas on one maze;
+    p and v are (R, n, 2). Returns the time each replica
+    solved the maze at (inf if it did not), and the number
+    of events of each; walls is the wall mask of edges,
+    worked out here if not given
+    """
+    if walls is None:
+        walls = wall_mask(edges)
+
+    # every step spans a whole log frame, as with --edmd
+    dt, n_steps = dt*stepsize, n_events//stepsize
+    p, v = np.array(p, dtype=np.float64), np.array(v, dtype=np.float64)
+    t, clock = 0, np.zeros(len(p))
+    table = BatchEvents(p, v, r, walls, clock)
+    next_e, *event = table.next_event(np.arange(len(p)), p, v, clock)
+    live, exit_t = np.ones(len(p), dtype=bool), np.full(len(p), np.inf)
+    for _ in range(n_steps):
+        p, v, next_e, event, t = batch_step(p, v, r, table, walls, t, next_e, event, dt, live)
+
+        # replicas whose first exit has come drop out
+        out = live & (table.exit <= t)
+        exit_t[out] = table.exit[out]
+        live &= ~out
+        print(f"\033[KI: Simulating timestep {t:.5f} s ({live.sum()} replicas left)\r",
+              end='', flush=True)
+        if not live.any():
+            break
+    print(f"\nI: {np.isfinite(exit_t).sum()} of {len(p)} replicas solved the maze")
+    return exit_t, table.events
+
+
+def initial_states(seeds, n, r, height, lattice=False):
+    """
+    Initial positions and velocities of one replica per seed,
+    as (R, n, 2) arrays; each replica is seeded like a single
+    run is, so the first one also leaves the random state
+    from which a single run would draw its maze
+    """
+    pos, vel = [], []
+    for s in reversed(seeds):
+        random.seed(s)
+        seed(s)
+        pos.append([[x, y+height] for x, y in initial_pos(n, r, lattice)])
+        vel.append(initial_vel(n))
+    return np.array(pos[::-1]), np.array(vel[::-1])
@@ -0,0 +1,380 @@
+#!/usr/bin/python
+"""
+Benchmarks
+
+Every stage of the pipeline is timed with fixed seeds, and the
+results can be saved as JSON and compared with an earlier run:
+    python bench.py --out new.json
+    python bench.py compare old.json new.json
+Results are times in seconds (lower is better), except for the
+ones whose name ends in per_s, which are rates (higher is better)
+"""
+import os
+import sys
+import json
+import random
+import platform
+import subprocess
+from time import perf_counter
+from tempfile import TemporaryDirectory
+from contextlib import redirect_stdout
+from argparse import ArgumentParser, MetavarTypeHelpFormatter
+from math import sqrt, pi
+import numpy as np
+from numpy.random import normal, seed
+from maze import make_maze
+from initialize import initial_pos, initial_vel
+from simulate import run_simulation, simulation_with_fan
+from domains import run_domains
+from trajectory import open_log, read_frames, read_paths
+
+# seconds a headless run may spend importing the simulation
+IMPORT_BUDGET = .3
+HEAVY = ("matplotlib", "cv2", "ffmpegcv")
+STAGES = ("imports", "maze", "init", "sim", "fan", "domains", "log", "render", "video")
+# engines and cell list settings the sim stage runs; numpy has no cell list
+SIMS = (("list", False), ("list", True), ("numpy", False))
+# numbers of strips the domains stage runs; compare with sim_list_cells_edmd
+WORKERS = (1, 2, 4)
+
+
+def _seed(x=0):
+    """
+    Seed both random generators
+    """
+    random.seed(x)
+    seed(x)
+
+
+def _system(n, size, fan=False):
+    """
+    Radius, positions, velocities and maze of a run, as wrapper
+    sets them up; the same ones every time
+    """
+    _seed()
+    r = sqrt((.2 if fan else .3)/n/pi)
+    pos = [[x, y+size] for x, y in initial_pos(n, r)]
+    vel = initial_vel(n)
+    return r, pos, vel, make_maze(size, size)
+
+
+def bench_import(module="wrapper", repeat=5):
+    """
+    Time importing module in a fresh interpreter, best of repeat;
+    returns the time and the plotting modules it pulled in
+    """
+    code = ("import sys, time; start = time.perf_counter(); import " + module +
+            "; print(time.perf_counter()-start); print(*[x for x in " + repr(HEAVY) +
+            " if x in sys.modules])")
+    best, heavy = float("inf"), []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True,
+                             check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        out = out.stdout.splitlines()
+        best, heavy = min(best, float(out[0])), out[1].split()
+    return best, heavy
+
+
+def bench_maze(size):
+    """
+    Time make_maze() on a size x size maze
+    """
+    _seed()
+    start = perf_counter()
+    make_maze(size, size)
+    return perf_counter() - start
+
+
+def bench_init(n):
+    """
+    Time initial_pos() and initial_vel() for n particles
+    """
+    _seed()
+    r = sqrt(.3/n/pi)
+    start = perf_counter()
+    initial_pos(n, r)
+    mid = perf_counter()
+    initial_vel(n)
+    return mid - start, perf_counter() - mid
+
+
+def bench_sim(n, size, steps, engine="list", edmd=False, fan=0, cell_list=False):
+    """
+    Run a simulation of n particles in a size x size maze for
+    steps steps; returns events and simulated seconds per second
+    """
+    r, pos, vel, edges = _system(n, size, fan)
+    with TemporaryDirectory() as out, open(os.devnull, 'w') as null, redirect_stdout(null):
+        start = perf_counter()
+        if fan:
+            t, *_, events = simulation_with_fan(n, n, pos, vel, r, edges, steps, fan, size, 5e-5,
+                                                2000, out, os.path.join(out, "simulation.log"),
+                                                cell_list, engine, edmd)
+        else:
+            t, *_, events = run_simulation(n, pos, vel, r, edges, steps, 5e-5, 2000, out,
+                                           os.path.join(out, "simulation.log"), cell_list, engine,
+                                           edmd)
+        elapsed = perf_counter() - start
+    return events/elapsed, t/elapsed
+
+
+def bench_domains(n, size, steps, workers):
+    """
+    Run bench_sim()'s simulation on workers strips of the maze;
+    returns events and simulated seconds per second
+    """
+    r, pos, vel, edges = _system(n, size)
+    with TemporaryDirectory() as out, open(os.devnull, 'w') as null, redirect_stdout(null):
+        start = perf_counter()
+        t, *_, events = run_domains(n, pos, vel, r, edges, steps, 5e-5, 2000, out,
+                                    os.path.join(out, "simulation.log"), workers)
+        elapsed = perf_counter() - start
+    return events/elapsed, t/elapsed
+
+
+def bench_log(n, frames, compress=None):
+    """
+    Time writing and reading back a log of frames
+    frames of n particles, compressed with the codec
+    compress if given; returns seconds per frame, seconds
+    to index the log by particle, and seconds to read the
+    whole path of one particle from that index
+    """
+    _seed()
+    pos, vel = normal(size=(n, 2)), normal(size=(n, 2))
+    with TemporaryDirectory() as out:
+        fname = os.path.join(out, "simulation.log")
+        start = perf_counter()
+        with open_log(fname, compress=compress) as log:
+            for i in range(frames):
+                log.write(i*.1, i, pos, vel)
+        mid = perf_counter()
+        for _, _, p, v in read_frames(fname):
+            np.asarray(p).sum()
+            np.asarray(v).sum()
+        end = perf_counter()
+        read_paths(fname, [n//2])
+        index = perf_counter()
+        read_paths(fname, [n//2])
+        path = perf_counter() - index
+    return (mid - start)/frames, (end - mid)/frames, index - end, path
+
+
+def bench_render(size, n, frames, with_arrows=False):
+    """
+    Time save_snap() on a size x size maze with n particles;
+    returns frames per second
+    """
+    from plot import save_snap
+    _seed()
+    edges = make_maze(size, size)
+    r = sqrt(.3/n/pi)
+    pos = [[random.uniform(0, size), random.uniform(0, size)] for _ in range(n)]
+    vel = [list(normal(size=2)) for _ in range(n)]
+    with TemporaryDirectory() as out:
+        save_snap(0, pos, vel, r, edges, out, with_arrows)
+        start = perf_counter()
+        for i in range(1, frames+1):
+            save_snap(i, pos, vel, r, edges, out, with_arrows)
+        elapsed = perf_counter() - start
+    return frames/elapsed
+
+
+def bench_video(size, n, frames):
+    """
+    Time make_video() on frames snapshots;
+    returns seconds per frame, or None without opencv
+    """
+    from plot import save_snap, make_video
+    _seed()
+    edges = make_maze(size, size)
+    r = sqrt(.3/n/pi)
+    with TemporaryDirectory() as out:
+        for i in range(frames):
+            pos = [[random.uniform(0, size), random.uniform(0, size)] for _ in range(n)]
+            save_snap(i, pos, pos, r, edges, out, False)
+        start = perf_counter()
+        if make_video(out):
+            return None
+        elapsed = perf_counter() - start
+    return elapsed/frames
+
+
+def run_suite(stages=STAGES, sizes=(10, 50, 100), nums=(100, 1000), num=50, steps=20000,
+              frames=10):
+    """
+    Run the benchmarks of stages; returns results by name
+    """
+    results = {}
+
+    def note(name, value):
+        results[name] = value
+        print(f"I: {name}: {value:.6g}")
+
+    if "imports" in stages:
+        elapsed, heavy = bench_import()
+        note("import_wrapper", elapsed)
+        if heavy:
+            print(f"W: Importing wrapper also loads {', '.join(heavy)}")
+        if elapsed > IMPORT_BUDGET:
+            print(f"W: Import time is over its budget of {IMPORT_BUDGET} s")
+    if "maze" in stages:
+        for size in sizes:
+            note(f"make_maze_{size}", bench_maze(size))
+    if "init" in stages:
+        for n in nums:
+            pos, vel = bench_init(n)
+            note(f"initial_pos_{n}", pos)
+            note(f"initial_vel_{n}", vel)
+    if "sim" in stages:
+        for engine, cell_list in SIMS:
+            for edmd in (False, True):
+                name = f"sim_{engine}{'_cells' if cell_list else ''}{'_edmd' if edmd else ''}"
+                events, sim_t = bench_sim(num, 10, steps, engine, edmd, 0, cell_list)
+                note(f"{name}_events_per_s", events)
+                note(f"{name}_sim_s_per_s", sim_t)
+    if "fan" in stages:
+        for cell_list in (False, True):
+            for edmd in (False, True):
+                name = f"fan_list{'_cells' if cell_list else ''}{'_edmd' if edmd else ''}"
+                events, sim_t = bench_sim(num, 10, steps, "list", edmd, 5, cell_list)
+                note(f"{name}_events_per_s", events)
+                note(f"{name}_sim_s_per_s", sim_t)
+    if "domains" in stages:
+        if os.cpu_count() < max(WORKERS):
+            print(f"W: Only {os.cpu_count()} cores; domains_{max(WORKERS)} cannot speed up fully")
+        for workers in WORKERS:
+            events, sim_t = bench_domains(num, 10, steps, workers)
+            note(f"domains_{workers}_events_per_s", events)
+            note(f"domains_{workers}_sim_s_per_s", sim_t)
+    if "log" in stages:
+        for compress in (None, "zlib"):
+            write, read, index, path = bench_log(max(nums), 10*frames, compress)
+            name = f"{'_' + compress if compress else ''}_{max(nums)}"
+            note(f"log_write{name}", write)
+            note(f"log_read{name}", read)
+            note(f"log_index{name}", index)
+            note(f"log_path{name}", path)
+    if "render" in stages:
+        for size in sizes:
+            note(f"save_snap_{size}", 1/bench_render(size, num, frames))
+    if "video" in stages:
+        per_frame = bench_video(min(sizes), num, frames)
+        if per_frame is None:
+            print("W: Skipping make_video; opencv is not installed")
+        else:
+            note(f"make_video_{min(sizes)}", per_frame)
+    return results
+
+
+def save_results(results, fname, params=None):
+    """
+    Save results as JSON, along with what they were measured
+    on and the parameters of the suite
+    """
+    data = {"python": platform.python_version(), "numpy": np.__version__,
+            "machine": platform.machine(), "cpus": os.cpu_count(), "params": params or {},
+            "results": results}
+    with open(fname, 'w') as file:
+        json.dump(data, file, indent=2)
+    return 0
+
+
+def compare(old, new, threshold=.1):
+    """
+    Compare two saved benchmark runs result by result; changes
+    within threshold (relative) count as noise. Returns the
+    number of results that got worse
+    """
+    with open(old, 'r') as file:
+        before = json.load(file)["results"]
+    with open(new, 'r') as file:
+        after = json.load(file)["results"]
+    worse = 0
+    print(f"{'benchmark':>36} {'old':>12} {'new':>12} {'change':>8}")
+    for name in sorted(set(before) | set(after)):
+        if name not in before or name not in after:
+            print(f"{name:>36} {'only in ' + (old if name in before else new)}")
+            continue
+        a, b = before[name], after[name]
+
+        # how much faster the new run is, whatever the unit
+        speedup = (b/a if name.endswith("per_s") else a/b) if a and b else 1
+        verdict = ""
+        if speedup > 1+threshold:
+            verdict = "faster"
+        elif speedup < 1/(1+threshold):
+            verdict, worse = "SLOWER", worse+1
+        print(f"{name:>36} {a:>12.6g} {b:>12.6g} {speedup:>7.2f}x {verdict}")
+    return worse
+
+
+def compare_main(argv):
+    """
+    Command line interface of the comparison
+    """
+    cli = ArgumentParser(prog="bench compare",
+                         description="Compare two saved benchmark runs",
+                         formatter_class=MetavarTypeHelpFormatter)
+    cli.add_argument("old", type=str, help="Results of the baseline run")
+    cli.add_argument("new", type=str, help="Results of the run to compare with it")
+    cli.add_argument("--threshold",
+                     default=.1, type=float,
+                     help="Relative change below which a difference counts as noise (default: 0.1)")
+    args = cli.parse_args(argv)
+    worse = compare(args.old, args.new, args.threshold)
+    if worse:
+        print(f"W: {worse} benchmarks got slower")
+    return int(bool(worse))
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["compare"]:
+        sys.exit(compare_main(sys.argv[2:]))
+    cli = ArgumentParser(prog="bench",
+                         description="Benchmarks for the maze diffusion pipeline; "
+                                     "'bench compare old.json new.json' compares two runs",
+                         formatter_class=MetavarTypeHelpFormatter)
+    cli.add_argument("--stages",
+                     default=list(STAGES), type=str, nargs='+', choices=STAGES,
+                     help="Stages to benchmark (default: all of them)")
+    cli.add_argument("--sizes",
+                     default=[10, 50, 100], type=int, nargs='+',
+                     help="Maze sizes to generate and render (default: 10 50 100)")
+    cli.add_argument("--nums",
+                     default=[100, 1000], type=int, nargs='+',
+                     help="Numbers of particles to initialize; the largest is also logged "
+                          "(default: 100 1000)")
+    cli.add_argument("--num",
+                     default=50, type=int,
+                     help="Number of particles to simulate and render (default: 50)")
+    cli.add_argument("--steps",
+                     default=20000, type=int,
+                     help="Number of steps to simulate; --edmd runs cover as much simulated time "
+                          "(default: 20000)")
+    cli.add_argument("--frames",
+                     default=10, type=int,
+                     help="Number of frames to render and merge (default: 10)")
+    cli.add_argument("--out",
+                     default=None, type=str,
+                     help="JSON file to save the results in (default: None)")
+    cli.add_argument("--imports",
+                     default=False, type=bool,
+                     help=f"Only time the simulation-only imports against a budget of {IMPORT_BUDGET} s "
+                          "(default: False)")
+    args = cli.parse_args()
+    if args.imports:
+        elapsed, heavy = bench_import()
+        print(f"I: Importing wrapper takes {elapsed:.3f} s (budget: {IMPORT_BUDGET} s)")
+        if heavy:
+            print(f"W: Importing wrapper also loads {', '.join(heavy)}")
+        if elapsed > IMPORT_BUDGET:
+            print("W: Import time is over budget")
+        sys.exit(int(bool(heavy) or elapsed > IMPORT_BUDGET))
+    results = run_suite(args.stages, args.sizes, args.nums, args.num, args.steps, args.frames)
+    if args.out:
+        params = {k: x for k, x in vars(args).items() if k not in ("out", "imports")}
+        params["sims"] = [{"engine": engine, "cell_list": cell_list} for engine, cell_list in SIMS]
+        params["workers"] = list(WORKERS)
+        save_results(results, args.out, params)
+        print(f"I: Results saved in {args.out}")
@@ -0,0 +1,136 @@
+"""
+Binary checkpoints of a running simulation
+
+A checkpoint is an uncompressed numpy .npz archive holding:
+    meta:    JSON (as bytes) with the run parameters, the time,
+             step and particle count, the pending event, and the
+             number of the last frame in the log
+    pos/vel: particle positions and velocities (n x 2 f8)
+    walls:   the maze wall mask; edges: maze walls (m x 2 x 2)
+    py_rng/np_rng: states of the random and numpy.random generators
+    queue_*: the state of the event queue, see EventQueue.state()
+Everything is stored exactly, so a resumed run takes the same steps
+the original one would have. A checkpoint is written to a temporary
+file first and moved over the old one, so a crash while writing
+leaves the previous checkpoint in place. The log is synced to disk
+before every checkpoint, so a checkpoint never gets ahead of its log
+"""
+import os
+import json
+import random
+import numpy as np
+from maze import wall_mask
+
+VERSION = 1
+
+
+def rng_state():
+    """
+    States of the random and numpy.random generators, as
+    arrays and the JSON-friendly rest
+    """
+    version, keys, gauss = random.getstate()
+    name, np_keys, pos, has_gauss, cached = np.random.get_state()
+    return ({"py_rng": np.array(keys, dtype=np.int64), "np_rng": np_keys},
+            {"py_rng": [version, gauss], "np_rng": [name, pos, has_gauss, cached]})
+
+
+def set_rng_state(arrays, meta):
+    """
+    Restore the states of both generators
+    """
+    version, gauss = meta["py_rng"]
+    random.setstate((version, tuple(arrays["py_rng"].tolist()), gauss))
+    name, pos, has_gauss, cached = meta["np_rng"]
+    np.random.set_state((name, arrays["np_rng"], pos, has_gauss, cached))
+    return 0
+
+
+def save_checkpoint(fname, meta, arrays):
+    """
+    Write a checkpoint atomically
+    """
+    tmp = f"{fname}.tmp"
+    with open(tmp, 'wb') as file:
+        np.savez(file, meta=np.frombuffer(json.dumps(meta).encode(), dtype=np.uint8), **arrays)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp, fname)
+    return 0
+
+
+def load_checkpoint(fname):
+    """
+    Read a checkpoint; returns its metadata and its arrays
+    """
+    with np.load(fname, allow_pickle=False) as data:
+        arrays = {k: data[k] for k in data.files if k != "meta"}
+        meta = json.loads(data["meta"].tobytes().decode())
+    if meta.get("version") != VERSION:
+        raise ValueError(f"{fname} is not a checkpoint this version can read")
+    return meta, arrays
+
+
+class Checkpointer:
+    """
+    Saves the state of a run of steps steps every few log frames;
+    attrs and edges describe the run, so that it can be set up again.
+    The wall mask of edges is worked out when first needed, unless
+    it is given as walls
+    """
+    def __init__(self, fname, every=100, attrs=None, edges=None, steps=0, walls=None):
+        self.fname = fname
+        self.every = max(every, 1)
+        self.attrs = attrs or {}
+        self.edges = edges
+        self.steps = steps
+        self.walls = walls
+
+    def put(self, frame, t, i, p, v, n, next_e, event, queue, log):
+        """
+        Save the state of the run after log frame frame,
+        if one is due; i is the number of the next step.
+        The open log is synced to disk first
+        """
+        if frame % self.every:
+            return 0
+        log.sync()
+        if self.walls is None:
+            self.walls = wall_mask(self.edges)
+        arrays, rng = rng_state()
+        arrays.update({"queue_" + k: x for k, x in queue.state().items()})
+        arrays.update(pos=np.array(p, dtype=np.float64).reshape(-1, 2),
+                      vel=np.array(v, dtype=np.float64).reshape(-1, 2),
+                      walls=self.walls, edges=np.array(self.edges, dtype=np.int64).reshape(-1, 2, 2))
+        meta = {"version": VERSION, "attrs": self.attrs, "rng": rng, "steps": self.steps,
+                "frame": frame, "log_frame": log.last, "t": t, "i": i, "n": n, "next_e": next_e,
+                "event": None if event is None else [int(x) for x in event]}
+        return save_checkpoint(self.fname, meta, arrays)
+
+
+def resume_state(meta, arrays):
+    """
+    Unpack a checkpoint into what run_simulation() needs to
+    carry on, and put the random generators back where they were
+    """
+    set_rng_state(arrays, meta["rng"])
+    return {"steps": meta["steps"], "frame": meta["frame"], "log_frame": meta.get("log_frame"),
+            "t": meta["t"], "i": meta["i"],
+            "n": meta["n"], "next_e": meta["next_e"],
+            "event": None if meta["event"] is None else tuple(meta["event"]),
+            "pos": arrays["pos"], "vel": arrays["vel"], "walls": arrays["walls"],
+            "queue": {k[6:]: x for k, x in arrays.items() if k.startswith("queue_")}}
+
+
+def check_log(log, resume, fname):
+    """
+    Make sure the log of a resumed run goes on up to the
+    frame its checkpoint was written at, so that the run
+    does not carry on after a gap in the log
+    """
+    if resume is None or resume["log_frame"] is None:
+        return 0
+    if log.last is None or log.last < resume["log_frame"]:
+        raise ValueError(f"{fname} ends before frame {resume['log_frame']} of the checkpoint, "
+                         "so the run cannot be resumed from it")
+    return 0
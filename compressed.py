@@ -0,0 +1,305 @@
+"""
+Compressed trajectory log
+
+Frames are stored in chunks that can each be decompressed on their
+own, so a reader can go straight to the chunk it needs, and several
+workers can decode different chunks side by side.
+
+Layout (little-endian):
+    header: magic (8 bytes), codec (u8), number of frames (u8),
+            number of chunks (u8), offset of chunk index (u8)
+    chunks: compressed size (u8), number of frames k (u8),
+            compressed payload
+    index:  offset and number of frames of every chunk (u8 each),
+            written when the log is closed
+A payload holds the times (k f8), frame numbers (k i8) and particle
+counts (k i8) of its frames, followed by their positions and velocities
+rounded to float32. These are stored as the difference between the
+bits of each value and the bits of the same value one frame earlier
+(particles new to a frame, and the first frame of a chunk, are taken
+against zero), with the bytes of all values regrouped by significance,
+which leaves long runs for the codec to squeeze. Like the plain log, a
+log whose run crashed has no index; its chunks are found by walking
+the chunk headers
+"""
+import os
+import zlib
+import lzma
+import struct
+from bisect import bisect_right
+import numpy as np
+
+MAGIC = b"MAZETRZ1"
+HEADER = struct.Struct("<8sQQQQ")
+CHUNK = struct.Struct("<QQ")
+CODECS = {"zlib": 1, "lzma": 2}
+
+
+def _compress(codec, data):
+    """
+    Compress a payload with codec
+    """
+    return zlib.compress(data, 6) if codec == CODECS["zlib"] else lzma.compress(data)
+
+
+def _decompress(codec, data):
+    """
+    Decompress a payload compressed with codec
+    """
+    return zlib.decompress(data) if codec == CODECS["zlib"] else lzma.decompress(data)
+
+
+def is_compressed(fname):
+    """
+    Check whether a file is a compressed trajectory log
+    """
+    if not os.path.exists(fname) or os.path.getsize(fname) < HEADER.size:
+        return False
+    with open(fname, 'rb') as file:
+        return file.read(len(MAGIC)) == MAGIC
+
+
+def _scan(file, start, end):
+    """
+    Walk the chunk headers to find chunk offsets and sizes
+    """
+    chunks = []
+    while start + CHUNK.size <= end:
+        file.seek(start)
+        size, k = CHUNK.unpack(file.read(CHUNK.size))
+        if start + CHUNK.size + size > end:
+            break
+        chunks.append((start, k))
+        start += CHUNK.size + size
+    return chunks, start
+
+
+def read_chunks(fname):
+    """
+    Get the codec of a compressed log, and the offset
+    and number of frames of each of its chunks
+    """
+    with open(fname, 'rb') as file:
+        magic, codec, _, count, index = HEADER.unpack(file.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f"{fname} is not a compressed trajectory log")
+        if index:
+            file.seek(index)
+            chunks = np.frombuffer(file.read(16*count), dtype="<u8").reshape(-1, 2).tolist()
+            return codec, [tuple(x) for x in chunks]
+        return codec, _scan(file, HEADER.size, os.path.getsize(fname))[0]
+
+
+def encode(frames):
+    """
+    Payload of a chunk of frames (time, frame number,
+    positions, velocities), uncompressed
+    """
+    times = np.array([x[0] for x in frames], dtype="<f8")
+    numbers = np.array([x[1] for x in frames], dtype="<i8")
+    counts = np.array([len(x[2]) for x in frames], dtype="<i8")
+    prev = np.zeros((2, 0, 2), dtype="<i4")
+    deltas = []
+    for _, _, pos, vel in frames:
+        bits = np.stack((pos, vel)).astype("<f4").view("<i4")
+        delta = bits.copy()
+        m = min(bits.shape[1], prev.shape[1])
+        delta[:, :m] -= prev[:, :m]
+        deltas.append(delta.ravel())
+        prev = bits
+    body = np.concatenate(deltas) if deltas else np.zeros(0, dtype="<i4")
+    return (times.tobytes() + numbers.tobytes() + counts.tobytes() +
+            body.view(np.uint8).reshape(-1, 4).T.tobytes())
+
+
+def decode(data, k):
+    """
+    Frames of a payload of k frames, with positions and
+    velocities as (n, 2) float64 arrays
+    """
+    times = np.frombuffer(data, dtype="<f8", count=k)
+    numbers = np.frombuffer(data, dtype="<i8", count=k, offset=8*k)
+    counts = np.frombuffer(data, dtype="<i8", count=k, offset=16*k)
+    body = np.frombuffer(data, dtype=np.uint8, offset=24*k).reshape(4, -1).T.copy().view("<i4").ravel()
+    frames, prev, start = [], np.zeros((2, 0, 2), dtype="<i4"), 0
+    for t, i, n in zip(times.tolist(), numbers.tolist(), counts.tolist()):
+        bits = body[start:start+4*n].reshape(2, n, 2).copy()
+        m = min(n, prev.shape[1])
+        bits[:, :m] += prev[:, :m]
+        start += 4*n
+        prev = bits
+        values = bits.view("<f4").astype(np.float64)
+        frames.append((t, i, values[0], values[1]))
+    return frames
+
+
+def pack_column(codec, pos):
+    """
+    Compress the positions of one particle over time,
+    coded like the frames of a chunk
+    """
+    bits = np.asarray(pos, dtype="<f4").reshape(-1, 2).view("<i4")
+    delta = bits.copy()
+    delta[1:] -= bits[:-1]
+    return _compress(codec, delta.view(np.uint8).reshape(-1, 4).T.tobytes())
+
+
+def unpack_column(codec, data):
+    """
+    Positions of a column compressed by pack_column()
+    """
+    data = np.frombuffer(_decompress(codec, data), dtype=np.uint8)
+    delta = data.reshape(4, -1).T.copy().view("<i4").reshape(-1, 2)
+    return np.cumsum(delta, axis=0, dtype="<i4").view("<f4").astype(np.float64)
+
+
+def read_chunk(fname, offset, codec=None):
+    """
+    Read and decode the chunk at offset
+    """
+    with open(fname, 'rb') as file:
+        if codec is None:
+            codec = HEADER.unpack(file.read(HEADER.size))[1]
+        file.seek(offset)
+        size, k = CHUNK.unpack(file.read(CHUNK.size))
+        return decode(_decompress(codec, file.read(size)), k)
+
+
+def plan_chunks(fname, start=0, stop=None, step=1):
+    """
+    Frames of a compressed log picked like read_frames() does,
+    grouped by chunk; returns the codec and a list of (chunk
+    offset, indices of the picked frames within the chunk)
+    """
+    codec, chunks = read_chunks(fname)
+    firsts = np.cumsum([0] + [k for _, k in chunks]).tolist()
+    plan = []
+    for j in range(firsts[-1])[start:stop:step]:
+        c = bisect_right(firsts, j) - 1
+        if not plan or plan[-1][0] != chunks[c][0]:
+            plan.append((chunks[c][0], []))
+        plan[-1][1].append(j-firsts[c])
+    return codec, plan
+
+
+def read_packed(fname, start=0, stop=None, step=1):
+    """
+    Go through the frames of a compressed log one by one,
+    picking them like read_frames() does; a chunk is only
+    decoded if one of its frames is picked
+    """
+    codec, plan = plan_chunks(fname, start, stop, step)
+    for offset, picks in plan:
+        frames = read_chunk(fname, offset, codec)
+        yield from (frames[j] for j in picks)
+
+
+class CompressedWriter:
+    """
+    Compressed trajectory log that stays open for a whole run,
+    written chunk frames at a time; frames are appended to an
+    existing log after dropping the frames numbered above until,
+    if until is given, and keep that log's codec
+    """
+    def __init__(self, fname, until=None, codec="zlib", chunk=64):
+        self.fname = fname
+        self.chunk = max(chunk, 1)
+        self.chunks, self.pending = [], []
+        self.last = None
+        if is_compressed(fname):
+            self.file = open(fname, 'r+b')
+            self.codec, self.chunks = read_chunks(fname)
+            end = HEADER.size
+            if self.chunks:
+                end = self.chunks[-1][0] + CHUNK.size + CHUNK.unpack(self._read(self.chunks[-1][0]))[0]
+
+            # frames past until are dropped; the ones before them
+            # in the same chunk go back to be compressed again
+            while until is not None and self.chunks:
+                offset, k = self.chunks[-1]
+                keep = [x for x in read_chunk(fname, offset, self.codec) if x[1] <= until]
+                if len(keep) == k:
+                    break
+                self.chunks.pop()
+                end, self.pending = offset, keep
+                if keep:
+                    break
+
+            # drop the old index until the log is closed again,
+            # so that a crash leaves a log that can still be scanned
+            self.file.truncate(end)
+            self.file.seek(0)
+            self.file.write(HEADER.pack(MAGIC, self.codec, 0, 0, 0))
+            self.file.seek(end)
+            if self.pending:
+                self.last = self.pending[-1][1]
+            elif self.chunks:
+                self.last = read_chunk(fname, self.chunks[-1][0], self.codec)[-1][1]
+        else:
+            if codec not in CODECS:
+                raise ValueError(f"Unknown codec {codec}; pick one of {', '.join(CODECS)}")
+            self.codec = CODECS[codec]
+            self.file = open(fname, 'wb')
+            self.file.write(HEADER.pack(MAGIC, self.codec, 0, 0, 0))
+
+    def _read(self, offset):
+        """
+        Read the header of the chunk at offset
+        """
+        self.file.seek(offset)
+        return self.file.read(CHUNK.size)
+
+    def flush(self):
+        """
+        Compress the pending frames into a chunk
+        """
+        if not self.pending:
+            return 0
+        data = _compress(self.codec, encode(self.pending))
+        self.chunks.append((self.file.tell(), len(self.pending)))
+        self.file.write(CHUNK.pack(len(data), len(self.pending)))
+        self.file.write(data)
+        self.pending = []
+        return 0
+
+    def write(self, t, i, pos, vel):
+        """
+        Append one frame
+        """
+        self.pending.append((t, i, np.asarray(pos, dtype="<f4").reshape(-1, 2),
+                             np.asarray(vel, dtype="<f4").reshape(-1, 2)))
+        self.last = i
+        if len(self.pending) >= self.chunk:
+            self.flush()
+        return 0
+
+    def sync(self):
+        """
+        Compress the pending frames into a chunk and
+        get every frame written so far onto disk
+        """
+        self.flush()
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return 0
+
+    def close(self):
+        """
+        Write the last chunk and the chunk index, and close the log
+        """
+        if self.file.closed:
+            return 0
+        self.flush()
+        index = self.file.tell()
+        self.file.write(np.array(self.chunks, dtype="<u8").reshape(-1, 2).tobytes())
+        self.file.seek(0)
+        self.file.write(HEADER.pack(MAGIC, self.codec, sum(k for _, k in self.chunks),
+                                    len(self.chunks), index))
+        self.file.close()
+        return 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,243 @@
+"""
+Domain-decomposed simulation: the maze is cut into vertical strips,
+each simulated by its own process
+
+Positions and velocities live in shared memory, twice over: every
+time window, each worker reads the state at the start of the window
+from one copy and writes the disks it owns, at the end of the window,
+into the other one, so workers never wait on each other mid-window.
+A worker owns the disks whose centre is in its strip, and also
+simulates copies of the disks within a one cell wide halo around
+it. A window is kept short enough that no disk from beyond the halo
+can reach the strip (in any direction, as a collision can turn a
+disk) at the fastest speed any disk could have: collisions of equal
+disks, and with walls, keep the total kinetic energy, so no disk
+ever moves faster than sqrt(sum |v|^2). Every collision a disk takes
+part in is then seen by its owner, even one between disks that a
+collision earlier in the window sped up. Each worker
+keeps its event queue from one window to the next: only the disks
+that came into or left its reach, and those whose owner ended the
+window somewhere else, are predicted again. A collision across a
+strip boundary is worked out by both sides on their own, the
+same way, so the run matches a single-process one. The bound is
+loose with many disks (about sqrt(n) times the typical speed), so
+windows get shorter as n grows; bench.py times the mode across
+numbers of workers
+"""
+from multiprocessing import Process, Queue
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+from maze import wall_mask
+from simulate import EXIT, EventQueue, jump_step
+from trajectory import open_log
+
+HALO = 1
+
+
+class _Strip:
+    """
+    One strip of the maze and its halo, simulated by one worker;
+    the event queue is kept from one window to the next, with
+    slot k of it holding disk ids[k] (-1 for a free slot)
+    """
+    def __init__(self, lo, hi, n, r, walls, halo=HALO):
+        self.lo, self.hi, self.halo = lo, hi, halo
+        self.r, self.walls = r, walls
+        self.slot = np.full(n, -1, dtype=np.int64)
+        self.ids, self.free = [], []
+        self.p, self.v = [], []
+        self.queue = EventQueue(self.p, self.v, r, walls, 0, cell_list=True, lazy=True)
+
+    def sync(self, p, v, t):
+        """
+        Bring the strip in line with the shared state at the
+        start of a window: disks that left the halo are dropped,
+        and disks that came in, or that a neighbour worked out
+        differently, are predicted again; returns the slots and
+        ids of the disks the strip owns
+        """
+        x = p[:, 0]
+        inside = (self.lo-self.halo <= x) & (x < self.hi+self.halo)
+        ids = np.array(self.ids, dtype=np.int64)
+        held = np.flatnonzero(ids >= 0)
+        gone, stay = held[~inside[ids[held]]], held[inside[ids[held]]]
+        self.queue.drop(gone.tolist())
+        for k in gone.tolist():
+            self.slot[self.ids[k]] = -1
+            self.ids[k] = -1
+            self.v[k] = [0., 0.]
+        self.free.extend(gone.tolist())
+
+        # disks still in reach only need predicting again if
+        # their owner ended the window somewhere else
+        ks = set()
+        if len(stay):
+            sub_p = np.array(self.p, dtype=np.float64).reshape(-1, 2)[stay]
+            sub_v = np.array(self.v, dtype=np.float64).reshape(-1, 2)[stay]
+            g = ids[stay]
+            for k in stay[((sub_p != p[g]) | (sub_v != v[g])).any(axis=1)].tolist():
+                self.p[k], self.v[k] = p[self.ids[k]].tolist(), v[self.ids[k]].tolist()
+                ks.add(k)
+        for j in np.flatnonzero(inside & (self.slot < 0)).tolist():
+            if self.free:
+                k = self.free.pop()
+                self.p[k], self.v[k], self.ids[k] = p[j].tolist(), v[j].tolist(), j
+            else:
+                k = len(self.p)
+                self.p.append(p[j].tolist())
+                self.v.append(v[j].tolist())
+                self.ids.append(j)
+            self.slot[j] = k
+            ks.add(k)
+        self.queue.add(ks, self.p, self.v, t)
+        g = np.flatnonzero(inside & (self.lo <= x) & (x < self.hi))
+        return self.slot[g], g
+
+    def window(self, bufs, src, t, window):
+        """
+        Simulate the strip for one window, and write the disks it
+        owns into the other copy of the state; returns the number
+        of events, and the exit of an owned disk as (time, particle)
+        if one left the maze
+        """
+        mine, ids = self.sync(bufs[2*src], bufs[2*src+1], t)
+        queue, events = self.queue, self.queue.events
+        next_e, event = queue.next_event(self.p, self.v, t)
+        self.p, self.v, next_e, event, end = jump_step(self.p, self.v, self.r, queue, self.walls,
+                                                       t, next_e, event, window)
+        queue.put_back(next_e, event, end)
+        out = None
+        if queue.exit and queue.exit[0] > end:
+
+            # leaves after the window; wait for it to come round again
+            queue.put_back(queue.exit[0]-end, (EXIT, queue.exit[1], 0), end)
+        elif queue.exit:
+            if queue.exit[1] in set(mine.tolist()):
+                out = (queue.exit[0], self.ids[queue.exit[1]])
+            queue.exit = None
+        bufs[2*(1-src)][ids] = np.array(self.p, dtype=np.float64).reshape(-1, 2)[mine]
+        bufs[2*(1-src)+1][ids] = np.array(self.v, dtype=np.float64).reshape(-1, 2)[mine]
+        return queue.events - events, out
+
+
+def _worker(lo, hi, names, n, r, walls, tasks, done):
+    """
+    Worker loop: simulate one strip, one window at a time
+    """
+    shm = [SharedMemory(name=x) for x in names]
+    bufs = [np.ndarray((n, 2), dtype=np.float64, buffer=x.buf) for x in shm]
+    strip = _Strip(lo, hi, n, r, walls)
+    for src, t, window in iter(tasks.get, None):
+        done.put(strip.window(bufs, src, t, window))
+    del bufs
+    for x in shm:
+        x.close()
+
+
+class Domains:
+    """
+    Pool of strip workers sharing the particle state; events
+    counts the events of every worker, so collisions across a
+    strip boundary count once on either side, and exit holds
+    the first disk to leave the maze as (time, particle)
+    """
+    def __init__(self, p, v, r, edges, workers, walls=None):
+        n = len(p)
+        max_x = max(x[1][0] for x in edges)
+        if walls is None:
+            walls = wall_mask(edges)
+        self.shm = [SharedMemory(create=True, size=max(16*n, 1)) for _ in range(4)]
+        self.bufs = [np.ndarray((n, 2), dtype=np.float64, buffer=x.buf) for x in self.shm]
+        self.bufs[0][:], self.bufs[1][:] = p, v
+        self.src = 0
+
+        # strips of whole cells; the outer ones reach out to infinity
+        cuts = [-np.inf] + [round(max_x*k/workers) for k in range(1, workers)] + [np.inf]
+        self.done = Queue()
+        self.tasks = [Queue() for _ in range(workers)]
+        self.workers = [Process(target=_worker,
+                                args=(cuts[k], cuts[k+1], [x.name for x in self.shm], n, r, walls,
+                                      self.tasks[k], self.done))
+                        for k in range(workers)]
+        for w in self.workers:
+            w.start()
+        self.r = r
+        self.events = 0
+        self.exit = None
+
+    def state(self):
+        """
+        Positions and velocities as they are now
+        """
+        return self.bufs[2*self.src], self.bufs[2*self.src+1]
+
+    def advance(self, t, dt):
+        """
+        Move the system on from t to t+dt, in windows short
+        enough for the halo to cover the fastest any disk can go
+        """
+        end = t + dt
+        while t < end:
+            _, v = self.state()
+            speed = np.sqrt((v**2).sum())
+            window = min(end-t, (HALO-2*self.r)/(2*speed) if speed else end-t)
+            for task in self.tasks:
+                task.put((self.src, t, window))
+            for _ in self.tasks:
+                events, out = self.done.get()
+                self.events += events
+                if out and (self.exit is None or out < self.exit):
+                    self.exit = out
+            self.src = 1-self.src
+            t += window
+        return end
+
+    def close(self):
+        """
+        Stop the workers and free the shared memory
+        """
+        for task in self.tasks:
+            task.put(None)
+        for w in self.workers:
+            w.join()
+        self.bufs = []
+        for x in self.shm:
+            x.close()
+            x.unlink()
+        return 0
+
+
+def run_domains(n, p, v, r, edges, n_events, dt, stepsize, out, logfile, workers, render=None,
+                log_budget=0, compress=None, walls=None):
+    """
+    Run Molecular Dynamics simulation on strips of the
+    maze in parallel, one log frame per step; log_budget,
+    compress and walls work as in run_simulation()
+    """
+    dt, n_steps = dt*stepsize, n_events//stepsize
+    t, i = 0, 0
+    domains = Domains(np.array(p, dtype=np.float64).reshape(-1, 2),
+                      np.array(v, dtype=np.float64).reshape(-1, 2), r, edges, workers, walls)
+    try:
+        with open_log(logfile, None, log_budget, compress) as log:
+            log.write(t, i, *domains.state())
+            if render:
+                render.put(i, *domains.state())
+            for i in range(1, n_steps+1):
+                t = domains.advance(t, dt)
+                p, v = domains.state()
+                log.write(t, i, p, v)
+                if render:
+                    render.put(i, p, v)
+                print(f"\033[KI: Simulating timestep {t:.5f} s\r", end='', flush=True)
+
+                # the workers keep track of particles leaving through the exit
+                if domains.exit:
+                    print(f"\nI: Timestep {t:.5f}; particle {domains.exit[1]} solved the maze "
+                          f"at {domains.exit[0]:.5f} s! Halting")
+                    return t, p.tolist(), v.tolist(), domains.exit, domains.events
+            p, v = domains.state()
+            print(f"\nI: Finished simulation for {t} timesteps")
+            return t, p.tolist(), v.tolist(), None, domains.events
+    finally:
+        domains.close()
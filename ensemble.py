@@ -0,0 +1,217 @@
+"""
+Run many independent replicas and collect their results
+"""
+import os
+import csv
+import random
+from time import perf_counter
+from itertools import product
+from contextlib import redirect_stdout
+from multiprocessing import Pool, cpu_count
+from argparse import ArgumentParser, MetavarTypeHelpFormatter
+from math import sqrt, pi
+from numpy.random import seed
+from wrapper import MazeDiffusion
+from maze import maze_walls
+from batched import run_batch, initial_states
+
+FIELDS = ["n", "height", "width", "pressure_factor", "seed", "maze_seed",
+          "solved", "exit_time", "events", "final_n", "wall_time"]
+
+
+def replicas(num, height, width, pressure_factor, seeds):
+    """
+    Every combination of the parameter lists, one replica each
+    """
+    return [{"n": n, "height": h, "width": w, "pressure_factor": f, "seed": s}
+            for n, h, w, f, s in product(num, height, width, pressure_factor, seeds)]
+
+
+def run_replica(rep, out, duration, **kwargs):
+    """
+    Run one replica in its own directory, seeded with its own seed,
+    which its maze is drawn from too; returns a row of the summary table
+    """
+    name = "n{n}_h{height}_w{width}_p{pressure_factor}_s{seed}".format(**rep)
+    rundir = os.path.join(out, name)
+    os.makedirs(rundir, exist_ok=True)
+    random.seed(rep["seed"])
+    seed(rep["seed"])
+    start = perf_counter()
+
+    # replicas run side by side, so each one talks to its own file
+    with open(os.path.join(rundir, "output.txt"), 'w') as file, redirect_stdout(file):
+        instance = MazeDiffusion(rep["n"], rep["height"], rep["width"],
+                                 logfile=os.path.join(rundir, "simulation.log"),
+                                 snapdir=os.path.join(rundir, "simulation_snapshots"),
+                                 pressure_factor=rep["pressure_factor"], **kwargs)
+        instance.simulate(duration)
+    return {**rep,
+            "maze_seed": rep["seed"],
+            "solved": int(bool(instance.indicator)),
+            "exit_time": instance.exit_time if instance.indicator else "",
+            "events": instance.events,
+            "final_n": instance.n,
+            "wall_time": round(perf_counter()-start, 3)}
+
+
+def run_batched(reps, out, duration, dt=5e-5, stepsize=2000, lattice=False, **kwargs):
+    """
+    Run replicas that only differ in their seed as one batch on
+    the maze of the first seed, on the batched engine whatever the
+    other options are; returns rows of the summary table, each with
+    the seed of the maze it ran on
+    """
+    n, height, width = reps[0]["n"], reps[0]["height"], reps[0]["width"]
+    rundir = os.path.join(out, f"n{n}_h{height}_w{width}_batch")
+    os.makedirs(rundir, exist_ok=True)
+    start = perf_counter()
+    with open(os.path.join(rundir, "output.txt"), 'w') as file, redirect_stdout(file):
+        r = sqrt(.3/n/pi)
+        pos, vel = initial_states([x["seed"] for x in reps], n, r, height, lattice)
+        edges, walls = maze_walls(width, height)
+        exit_t, events = run_batch(pos, vel, r, edges, int(duration), dt, stepsize, walls)
+    wall_time = round((perf_counter()-start)/len(reps), 3)
+    return [{**rep,
+             "maze_seed": reps[0]["seed"],
+             "solved": int(exit_t[k] < float("inf")),
+             "exit_time": float(exit_t[k]) if exit_t[k] < float("inf") else "",
+             "events": int(events[k]),
+             "final_n": n,
+             "wall_time": wall_time} for k, rep in enumerate(reps)]
+
+
+def _run(job):
+    """
+    Pool helper; runs a list of replicas as a batch,
+    or a single one by itself
+    """
+    rep, out, duration, kwargs = job
+    if isinstance(rep, list):
+        return run_batched(rep, out, duration, **kwargs)
+    return [run_replica(rep, out, duration, **kwargs)]
+
+
+def run_ensemble(reps, out="ensemble", duration=1e5, workers=0, batched=False, **kwargs):
+    """
+    Run replicas on a pool of processes and write
+    the summary table to out/summary.csv; with batched,
+    replicas without pressure that only differ in their
+    seed share the maze of the first of them and run together
+    in one process, on the batched engine
+    """
+    os.makedirs(out, exist_ok=True)
+    jobs, rows = [], []
+    if batched and (kwargs.get("engine", "list") != "list" or kwargs.get("edmd") or
+                    kwargs.get("cell_list")):
+        print("W: Batched replicas always run the batched engine, event to event and with "
+              "every pair checked; --engine, --edmd and --cell_list only apply to the "
+              "replicas with pressure")
+    if batched:
+        groups = {}
+        for rep in reps:
+            if rep["pressure_factor"]:
+                jobs.append(rep)
+            else:
+                groups.setdefault((rep["n"], rep["height"], rep["width"]), []).append(rep)
+        jobs += groups.values()
+    else:
+        jobs = reps
+    with Pool(workers or cpu_count()) as pool:
+        for done in pool.imap_unordered(_run, [(job, out, duration, kwargs) for job in jobs]):
+            rows += done
+            print(f"\033[KI: Finished {len(rows)} of {len(reps)} replicas\r", end='', flush=True)
+    print()
+    rows.sort(key=lambda x: [x[k] for k in FIELDS[:5]])
+    with open(os.path.join(out, "summary.csv"), 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    return rows
+
+
+def print_summary(rows):
+    """
+    Print the summary table, with the share of replicas that
+    solved the maze and their mean exit time per parameter set
+    """
+    print(" ".join(f"{x:>15}" for x in FIELDS))
+    for row in rows:
+        print(" ".join(f"{row[x]:>15.5f}" if isinstance(row[x], float) else f"{row[x]:>15}"
+                       for x in FIELDS))
+    groups = {}
+    for row in rows:
+        groups.setdefault(tuple(row[k] for k in FIELDS[:4]), []).append(row)
+    print()
+    for key, group in groups.items():
+        times = [x["exit_time"] for x in group if x["solved"]]
+        mean = f"{sum(times)/len(times):.5f} s" if times else "-"
+        print(f"I: n={key[0]} {key[1]}x{key[2]} pressure {key[3]}: "
+              f"{len(times)}/{len(group)} solved, mean exit time {mean}")
+    return 0
+
+
+def main(argv=None):
+    """
+    Command line interface of the ensemble runner
+    """
+    cli = ArgumentParser(prog="maze_diffusion ensemble",
+                         description="Run many replicas of the maze diffusion simulation",
+                         formatter_class=MetavarTypeHelpFormatter)
+    cli.add_argument("--num",
+                     default=[10], type=int, nargs='+',
+                     help="Numbers of particles (default: 10)")
+    cli.add_argument("--height",
+                     default=[10], type=int, nargs='+',
+                     help="Maze heights (default: 10)")
+    cli.add_argument("--width",
+                     default=[10], type=int, nargs='+',
+                     help="Maze widths (default: 10)")
+    cli.add_argument("--pressure_factor",
+                     default=[0], type=int, nargs='+',
+                     help="Pressure factors (default: 0)")
+    cli.add_argument("--seeds",
+                     default=[0], type=int, nargs='+',
+                     help="Random seeds; every parameter set runs once per seed (default: 0)")
+    cli.add_argument("--duration",
+                     default=1e5, type=float,
+                     help="Number of steps to simulate each replica for (default: 1e5)")
+    cli.add_argument("--stepsize",
+                     default=2000, type=int,
+                     help="Number of steps between logged frames (default: 2000)")
+    cli.add_argument("--dt",
+                     default=5e-5, type=float,
+                     help="Size of one simulation step (default: 5e-5)")
+    cli.add_argument("--engine",
+                     default="list", type=str, choices=["list", "numpy"],
+                     help="Simulation engine (default: 'list')")
+    cli.add_argument("--edmd",
+                     default=False, type=bool,
+                     help="Jump from event to event instead of sub-stepping (default: False)")
+    cli.add_argument("--cell_list",
+                     default=False, type=bool,
+                     help="Only look for pair collisions in adjacent maze cells (default: False)")
+    cli.add_argument("--batched",
+                     default=False, type=bool,
+                     help="Run replicas without pressure that only differ in their seed as one batch "
+                          "on the maze of the first seed, with the batched engine; the summary "
+                          "table gives the seed of the maze each replica ran on (default: False)")
+    cli.add_argument("--out",
+                     default="ensemble", type=str,
+                     help="Directory for the replicas and the summary table (default: 'ensemble')")
+    cli.add_argument("--workers",
+                     default=0, type=int,
+                     help="Number of worker processes (default: one per core)")
+    args = cli.parse_args(argv)
+    reps = replicas(args.num, args.height, args.width, args.pressure_factor, args.seeds)
+    print(f"I: Running {len(reps)} replicas on {args.workers or cpu_count()} processes")
+    rows = run_ensemble(reps, args.out, args.duration, args.workers, args.batched,
+                        dt=args.dt, stepsize=args.stepsize, engine=args.engine,
+                        edmd=args.edmd, cell_list=args.cell_list)
+    print_summary(rows)
+    print(f"I: Summary table saved in {os.path.join(args.out, 'summary.csv')}")
+    return 0
+
+
+if __name__ == "__main__":
+    main()
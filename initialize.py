@@ -1,28 +1,58 @@
 """
 Initialize positions and velocities
 """
-from random import uniform, choice
-from math import sqrt
+from random import uniform, choice, sample
+from math import sqrt, ceil
 from numpy.random import normal
 
 
-def initial_pos(n, r):
+def initial_pos(n, r, lattice=False, tries=1000):
     """
     Initialize positions of disk in 1x1 box
     """
+    if lattice:
+        return lattice_pos(n, r)
+
     # going for random sequential deposition instead of Monte Carlo
     # since we don't care about sampling the phase space 'appropriately'
-    box = [[uniform(r, 1-r), uniform(r, 1-r)]]
-    for _ in range(1, n):
-        while True:
+    # disks are hashed into cells at least 2r wide, so a new disk
+    # only needs to be checked against the 3x3 cells around it
+    m = max(int(1/(2*r)), 1)
+    grid, box = {}, []
+    while len(box) < n:
+        for _ in range(tries):
             new = [uniform(r, 1-r), uniform(r, 1-r)]
-            dist = min(sqrt((new[0]-b[0])**2 + (new[1]-b[1])**2) for b in box)
-            if dist > 2*r:
+            c_x, c_y = min(int(new[0]*m), m-1), min(int(new[1]*m), m-1)
+            if all(sqrt((new[0]-b[0])**2 + (new[1]-b[1])**2) > 2*r
+                   for i in range(c_x-1, c_x+2) for j in range(c_y-1, c_y+2)
+                   for b in grid.get((i, j), ())):
                 break
+        else:
+            print(f"W: Random placement got stuck after {len(box)} of {n} disks; "
+                  "placing them on a lattice instead")
+            return lattice_pos(n, r)
+        grid.setdefault((c_x, c_y), []).append(new)
         box.append(new)
-        if len(box) == n:
-            return box
-    return 1
+    return box
+
+
+def lattice_pos(n, r):
+    """
+    Initialize positions of disk in 1x1 box on a square
+    lattice, each disk jittered randomly around its site
+    """
+    k = ceil(sqrt(n))
+    if k <= 1:
+        return [[uniform(r, 1-r), uniform(r, 1-r)] for _ in range(n)]
+    space = (1-2*r)/(k-1)
+    if space <= 2*r:
+        raise ValueError(f"{n} disks of radius {r} do not fit in the box")
+
+    # jitter less than half the gap, so that neighbours never touch
+    jit = .49*(space-2*r)
+    sites = sample(range(k*k), n)
+    return [[r + space*(s%k) + uniform(-jit, jit)*(0 < s%k < k-1),
+             r + space*(s//k) + uniform(-jit, jit)*(0 < s//k < k-1)] for s in sites]
 
 
 def initial_vel(n):
@@ -38,9 +68,12 @@ def initial_vel(n):
     return vel
 
 
-def particle_shower(pos, vel, r, e_p, orig_n):
+def particle_shower(pos, vel, r, e_p, orig_n, nearby=None, tries=1000):
     """
-    Add particles with force into the system
+    Add particles with force into the system;
+    also returns which particle was added or pushed.
+    nearby lists the particles that can be in or next
+    to the entry cell; all of them are checked if not given
     """
     # how many particles we can add also depends on current
     # particle density in the entry strip
@@ -53,25 +86,38 @@ def particle_shower(pos, vel, r, e_p, orig_n):
     # particles will have only variance in the x-coordinate
     new_pos, new_vel, extras = [], [], len(pos)-orig_n
     prob = uniform(0, 1) < (orig_n-extras)/(orig_n+extras)  # maffs
-    to_push = [b for a, b in zip(pos, vel) if int(a[1]) == e_p]
+
+    # a new particle goes in the top strip of the entry cell, so
+    # only particles within reach of that strip can get in the way
+    to_push, near = [], []
+    for k in range(len(pos)) if nearby is None else nearby:
+        a = pos[k]
+        if int(a[1]) == e_p:
+            to_push.append(k)
+        if a[1] > e_p+1-4.2*r:
+            near.append(a)
     if not to_push:
         prob = 1
     if prob:
-        while True:
+        for _ in range(tries):
             new_pos = [uniform(r*1.05, 1-r*1.05), uniform(1-2*r*1.05, 1-r*1.05)+e_p]
-            dist = min(sqrt((new_pos[0]-b[0])**2+(new_pos[1]-b[1])**2) for b in pos)
-            if dist > 2*r:
+            if all(sqrt((new_pos[0]-b[0])**2+(new_pos[1]-b[1])**2) > 2*r for b in near):
                 break
+        else:
+
+            # the strip is full; push a particle instead, if there is one
+            new_pos = []
+            if not to_push:
+                return pos, vel, None
+    if new_pos:
 
         # similarly, velocities will have almost no
         # velocity in the x-direction, and only go downwards
         new_vel = [[uniform(-.1, .1), -abs(normal(size=1)[0])]]
-    else:
+        return pos+[new_pos], vel+new_vel, len(pos)
 
-        # we don't always add a particle; sometimes we simply push
-        # an existing particle through an apparent force
-        v = choice(to_push)
-        vel[vel.index(v)][1] -= abs(uniform(0, 1))
-    if new_pos:
-        return pos+[new_pos], vel+new_vel
-    return pos, vel
+    # we don't always add a particle; sometimes we simply push
+    # an existing particle through an apparent force
+    k = choice(to_push)
+    vel[k][1] -= abs(uniform(0, 1))
+    return pos, vel, k
@@ -2,10 +2,15 @@
 """
 Interface file
 """
-from sys import argv
+import sys
 from argparse import ArgumentParser, MetavarTypeHelpFormatter
 from wrapper import MazeDiffusion
 
+# many replicas at once are run through a subcommand
+if sys.argv[1:2] == ["ensemble"]:
+    from ensemble import main
+    sys.exit(main(sys.argv[2:]))
+
 
 cli = ArgumentParser(prog="maze_diffusion",
                      description="Gas Diffusion in a 2D Maze",
@@ -26,19 +31,44 @@ cli.add_argument("--duration",
                  One second corresponds to 20,000 steps with default dt value (default: 1e10)""")
 cli.add_argument("--stepsize",
                  default=2000, type=int,
-                 help="Save plots every x iterations (default: 2000)")
+                 help="Save plots every x iterations; with --edmd, every x*dt of simulated time (default: 2000)")
 cli.add_argument("--pressure_factor",
                  default=0, type=int, choices=list(range(11)),
                  help="Apply pressure from the entry point. Takes values between 0-10 (default: 0)")
 cli.add_argument("--dt",
                  default=5e-5, type=float,
                  help="Size of one simulation step (default: 5e-5)")
+cli.add_argument("--lattice",
+                 default=False, type=bool,
+                 help="Start particles on a jittered lattice instead of random placement (default: False)")
+cli.add_argument("--cell_list",
+                 default=False, type=bool,
+                 help="Only look for pair collisions between particles in adjacent maze cells (default: False)")
+cli.add_argument("--engine",
+                 default="list", type=str, choices=["list", "numpy"],
+                 help="Simulation engine; 'numpy' batches collision times into arrays (default: 'list')")
+cli.add_argument("--edmd",
+                 default=False, type=bool,
+                 help="Jump straight from event to event instead of moving every particle each dt (default: False)")
+cli.add_argument("--domains",
+                 default=0, type=int,
+                 help="Split the maze into this many strips, each simulated by its own process; "
+                      "implies --edmd and --cell_list (default: 0, i.e. off)")
 cli.add_argument("--logfile",
                  default="simulation.log", type=str,
                  help="Name of log file (default: 'simulation.log')")
 cli.add_argument("--snapdir",
                  default="simulation_snapshots", type=str,
                  help="Directory to save simulation snapshots in (default: 'simulation_snapshots')")
+cli.add_argument("--frames",
+                 default="::", type=str,
+                 help="Log frames to make snapshots of, as start:stop:step (default: '::', i.e. all of them)")
+cli.add_argument("--live_snaps",
+                 default=False, type=bool,
+                 help="Draw snapshots while the simulation runs instead of afterwards (default: False)")
+cli.add_argument("--no_png",
+                 default=False, type=bool,
+                 help="Draw snapshots straight into the video without saving them as PNGs (default: False)")
 cli.add_argument("--arrows",
                  default=False, type=bool,
                  help="Whether to draw velocity arrows in simulation snapshots (default: False)")
@@ -48,6 +78,25 @@ cli.add_argument("--i_file",
 cli.add_argument("--o_file",
                  default=None, type=str,
                  help="JSON file to save the object in after every simulation (default: None)")
+cli.add_argument("--checkpoint",
+                 default=None, type=str,
+                 help="File to save a checkpoint of the running simulation in (default: None)")
+cli.add_argument("--checkpoint_every",
+                 default=100, type=int,
+                 help="Number of logged frames between checkpoints (default: 100)")
+cli.add_argument("--resume",
+                 default=None, type=str,
+                 help="Checkpoint file to resume an interrupted simulation from (default: None)")
+cli.add_argument("--profile",
+                 default=None, type=str,
+                 help="JSON file to save counts and timings of the simulation loop in (default: None)")
+cli.add_argument("--log_budget",
+                 default=0, type=float,
+                 help="Size in MB to keep the simulation log within by thinning out older frames; "
+                      "0 keeps every frame (default: 0)")
+cli.add_argument("--compress",
+                 default=None, type=str, choices=["zlib", "lzma"],
+                 help="Write a new simulation log compressed, in chunks, with this codec (default: None)")
 cli.add_argument("--pos_i",
                  default=None, type=str,
                  help="Input file containing initial positions of particles (default: None)")
@@ -66,6 +115,9 @@ cli.add_argument("--vel_o",
 cli.add_argument("--maze_o",
                  default=None, type=str,
                  help="Filename to save maze wall coordinates in (default: None)")
+cli.add_argument("--log_o",
+                 default=None, type=str,
+                 help="Filename to export the simulation log in as plain text (default: None)")
 cli.add_argument("--no_sim",
                  default=False, type=bool,
                  help="Skip any simulation (default: False)")
@@ -77,7 +129,7 @@ cli.add_argument("--no_trace",
                  help="Skip saving the trace path of exiting particle (default: False)")
 
 
-args = cli.parse_args(args=None if argv[1:] else ["--help"])
+args = cli.parse_args(args=None if sys.argv[1:] else ["--help"])
 print(cli.description)
 cli.print_usage()
 print()
@@ -91,15 +143,28 @@ arg_dct = {"dt": args.dt,
            "maze": args.maze_i,
            "positions": args.pos_i,
            "velocities": args.vel_i,
-           "pressure_factor": args.pressure_factor}
+           "pressure_factor": args.pressure_factor,
+           "cell_list": args.cell_list,
+           "engine": args.engine,
+           "edmd": args.edmd,
+           "live_snaps": args.live_snaps,
+           "save_pngs": not args.no_png,
+           "lattice": args.lattice,
+           "domains": args.domains,
+           "checkpoint": args.checkpoint,
+           "checkpoint_every": args.checkpoint_every,
+           "resume": args.resume,
+           "profile": args.profile,
+           "log_budget": int(args.log_budget*2**20),
+           "compress": args.compress}
 instance = MazeDiffusion(args.num, args.height, args.width, **arg_dct)
 if not args.no_sim:
     instance.simulate(args.duration)
 print()
 print(instance)
 print()
-if not args.no_snap:
-    instance.make_snaps()
+if not args.no_snap and not (args.live_snaps and not args.no_sim):
+    instance.make_snaps(*(int(x) if x else None for x in args.frames.split(':')))
 if not args.no_trace:
     instance.trace_path()
 if args.pos_o:
@@ -108,4 +173,6 @@ if args.vel_o:
     instance.save_vel(args.vel_o)
 if args.maze_o:
     instance.save_maze(args.maze_o)
+if args.log_o:
+    instance.export_log(args.log_o)
 print(f"\n{cli.epilog}\n")
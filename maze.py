@@ -1,149 +1,151 @@
 """
 Create a 2D maze
 """
-from random import uniform, choice
+import gc
+from itertools import chain
+import numpy as np
 
+# wall bits in the per-cell wall mask
+RIGHT, LEFT, TOP, BOTTOM = 1, 2, 4, 8
 
-def fix_path(n, is_in_path, conns):
+
+def spanning_tree(m, n):
     """
-    Fix path on grid to add any missing nodes
+    Pick a random spanning tree of the m x n grid of cells;
+    returns which neighbours are joined along x, an (m-1, n)
+    array, and along y, an (m, n-1) array
     """
-    while not all(is_in_path.values()):
-        strays = [k for k, v in is_in_path.items() if not v]
-        for cur in strays:
-
-            # maybe we already passed through this box in an
-            # earlier iteration of this same loop
-            if not is_in_path[cur]:
-                connected = False
-                c = cur
-                while not connected:
-                    nbrs = [c+1, c-1, c+n, c-n]
-                    nbrs = [x for x in nbrs if x in is_in_path]
-                    if not c%n:
-                        nbrs.remove(c+1)
-                    elif c%n == 1:
-                        nbrs.remove(c-1)
-                    pick = choice(nbrs)
-                    conns[c].append(pick)
-                    conns[pick].append(c)
-                    is_in_path[c] = True
-                    if is_in_path[pick]:
-                        connected = True
-                    else:
-                        c = pick
-    return conns
-
-
-def create_path(m, n):
+    # Boruvka's algorithm on randomly weighted edges: every round,
+    # each group of joined cells takes its lightest edge out of the
+    # group, so there are only about log(m*n) rounds, each of which
+    # works on whole arrays. Edge k joins groups a[k] and b[k], and
+    # weighs its position in order; groups are renumbered after
+    # every round, so the arrays shrink as the groups merge
+    ids = np.arange(m*n).reshape(m, n)
+    edge = np.random.permutation((m-1)*n + m*(n-1))
+    a = np.concatenate((ids[:-1].ravel(), ids[:, :-1].ravel()))[edge]
+    b = np.concatenate((ids[1:].ravel(), ids[:, 1:].ravel()))[edge]
+    tree = np.zeros(len(a), dtype=bool)
+    size = m*n
+    while len(a):
+        rank = np.arange(len(a))
+        best = np.full(size, len(a))
+        np.minimum.at(best, a, rank)
+        np.minimum.at(best, b, rank)
+        picked = np.zeros(len(a)+1, dtype=bool)
+        picked[best] = True
+        tree[edge[picked[:-1]]] = True
+
+        # each group points at the group its edge leads to; two
+        # groups that picked the same edge point at each other,
+        # and the smaller one of those becomes the root
+        group = np.arange(size)
+        k = best % len(a)
+        parent = np.where(best == len(a), group, np.where(a[k] == group, b[k], a[k]))
+        mutual = (parent[parent] == group) & (parent > group)
+        parent[mutual] = group[mutual]
+        while True:
+            up = parent[parent]
+            if np.array_equal(up, parent):
+                break
+            parent = up
+        root = parent == group
+        label = np.cumsum(root) - 1
+        a, b = label[parent[a]], label[parent[b]]
+        out = a != b
+        a, b, edge = a[out], b[out], edge[out]
+        size = int(root.sum())
+    split = (m-1)*n
+    return tree[:split].reshape(m-1, n), tree[split:].reshape(m, n-1)
+
+
+def _runs(lines):
     """
-    Create a path through a grid
+    Start and end of every run of walls along the rows of lines
     """
-    is_in_path = {x: False for x in range(1, m*n+1)}
-    conns = {x: [] for x in is_in_path}
-    current = [1]
-    is_in_path[1] = True
-    check = 0
-
-    # create a main path
-    while current:
-        check += 1
-        cur = current.pop()
-        nbrs = [cur+1, cur-1, cur+n, cur-n]
-
-        # if you're at the edge of the grid, don't fall off
-        if not cur%n:
-            nbrs.remove(cur+1)
-        elif cur%n == 1:
-            nbrs.remove(cur-1)
-        nbrs = [x for x in nbrs if x in is_in_path]
-
-        # since we don't want to go in every possible direction
-        do_more = uniform(0, 1)
-        while do_more < .99 and nbrs:
-            nxt = choice(nbrs)
-            nbrs.remove(nxt)
-            if not is_in_path[nxt]:
-                conns[cur].append(nxt)
-                conns[nxt].append(cur)
-                is_in_path[nxt] = True
-                is_in_path[cur] = True
-                current.append(nxt)
-            do_more = uniform(0, 1)
-
-        # in case we run into infinite loop, run the function again
-        if check > 1e4:
-            return create_path(m, n)
-
-    # then add any missed boxes to path
-    conns = fix_path(n, is_in_path, conns)
-
-    # that's it
-    return conns
-
-
-def maze_grid(m, n):
+    pad = np.zeros((lines.shape[0], lines.shape[1]+2), dtype=np.int8)
+    pad[:, 1:-1] = lines
+    step = np.diff(pad, axis=1)
+    start, end = np.nonzero(step == 1), np.nonzero(step == -1)
+    return start[0], start[1], end[1]
+
+
+def maze_walls(m, n=0):
     """
-    Create 2D grid
+    Make 2D maze as arrays; returns the edges along
+    with the wall mask that wall_mask() would give
     """
-    # instantiate variables
-    nodes, edges = {}, []
-
-    # first set up nodes
-    for i in range(m+1):
-        nodes[i] = {}
-        for j in range(n+1):
-            nodes[i][j] = (i, j)
-
-    # create path through the maze
-    conns = create_path(m, n)
-
-    # add edges at the border of the maze
-    for i in range(m):
-        edges.append((nodes[i][0], nodes[i+1][0]))
-        edges.append((nodes[i][n], nodes[i+1][n]))
-    for i in range(n):
-        edges.append((nodes[0][i], nodes[0][i+1]))
-        edges.append((nodes[m][i], nodes[m][i+1]))
-
-    # now add edges so as to preserve path
-    for b in range(1, m*n+1):
-        i, j = b//n+1, b%n
-        if not j:
-            j = n
-            i -= 1
-        box = {b-n: (nodes[i-1][j-1], nodes[i-1][j]),
-               b-1: (nodes[i-1][j-1], nodes[i][j-1]),
-               b+1: (nodes[i-1][j], nodes[i][j]),
-               b+n: (nodes[i][j-1], nodes[i][j])}
-        for nbr, wall in box.items():
-            if nbr not in conns[b]:
-                edges.append(wall)
-
-    # done
-    return edges
+    if n == 0:
+        n = m
+    join_x, join_y = spanning_tree(m, n)
+
+    # vert[x, y] is the wall from (x, y) to (x, y+1), and
+    # horz[x, y] the one from (x, y) to (x+1, y); row n of
+    # cells holds the entry point on top of the maze
+    vert = np.zeros((m+1, n+1), dtype=bool)
+    horz = np.zeros((m, n+2), dtype=bool)
+    vert[0, :n] = vert[m, :n] = True
+    vert[1:m, :n] = ~join_x
+    horz[:, 0] = horz[:, n] = True
+    horz[:, 1:n] = ~join_y
+
+    # entry point and exit
+    vert[0, n] = vert[1, n] = horz[0, n+1] = True
+    horz[0, n] = horz[m-1, 0] = False
+
+    # cell (i, j) is stored at [i+1, j+1], as in wall_mask()
+    mask = np.zeros((m+2, n+3), dtype=np.uint8)
+    mask[:m+1, 1:n+2] |= vert*np.uint8(RIGHT)
+    mask[1:, 1:n+2] |= vert*np.uint8(LEFT)
+    mask[1:m+1, :n+2] |= horz*np.uint8(TOP)
+    mask[1:m+1, 1:] |= horz*np.uint8(BOTTOM)
+
+    # straight runs of wall become one edge each; the garbage
+    # collector is held off while millions of tuples are made
+    x, y_0, y_1 = (r.tolist() for r in _runs(vert))
+    y, x_0, x_1 = (r.tolist() for r in _runs(horz.T))
+    collect = gc.isenabled()
+    gc.disable()
+    try:
+        edges = list(zip(zip(x, y_0), zip(x, y_1)))
+        edges += zip(zip(x_0, y), zip(x_1, y))
+    finally:
+        if collect:
+            gc.enable()
+    return edges, mask
 
 
 def make_maze(m, n=0):
     """
     Main function to make 2D maze
     """
-    # all that's left is adding an entry and exit point
-    if n == 0:
-        n = m
-    edges = maze_grid(m, n)
-
-    # entry point
-    edges.append(((0, n), (0, n+1)))
-    edges.append(((0, n+1), (1, n+1)))
-    edges.append(((1, n+1), (1, n)))
-    edges.append(((0, n+1), (0, n)))
-    edges.append(((1, n+1), (0, n+1)))
-    edges.append(((1, n), (1, n+1)))
-
-    # make way
-    for rem in [((0, n), (1, n)), ((1, n), (0, n)), ((m-1, 0), (m, 0)), ((m, 0), (m-1, 0))]:
-        while rem in edges:
-            edges.remove(rem)
-
-    return edges
+    return maze_walls(m, n)[0]
+
+
+def wall_mask(edges):
+    """
+    Build a per-cell wall mask from the maze edges;
+    cell (i, j) is stored at [i+1, j+1] so that the
+    row of cells below the exit fits in as well
+    """
+    ends = np.fromiter(chain.from_iterable(chain.from_iterable(edges)),
+                       dtype=np.intp, count=4*len(edges)).reshape(-1, 4)
+    x_0, y_0, x_1, y_1 = ends.T
+    max_x, max_y = int(max(x_0.max(), x_1.max())), int(max(y_0.max(), y_1.max()))
+    mask = np.zeros((max_x+2, max_y+2), dtype=np.uint8)
+
+    # split every edge into its unit segments
+    lo = np.where(x_0 == x_1, np.minimum(y_0, y_1), np.minimum(x_0, x_1))
+    size = np.where(x_0 == x_1, np.abs(y_1-y_0), np.abs(x_1-x_0))
+    at = np.repeat(lo - np.cumsum(size) + size, size) + np.arange(size.sum())
+    fix = np.repeat(x_0, size)
+    vert = np.repeat(x_0 == x_1, size)
+    fix[~vert] = np.repeat(y_0, size)[~vert]
+
+    x, y = fix[vert], at[vert]
+    np.bitwise_or.at(mask, (x, y+1), RIGHT)
+    np.bitwise_or.at(mask, (x+1, y+1), LEFT)
+    x, y = at[~vert], fix[~vert]
+    np.bitwise_or.at(mask, (x+1, y), TOP)
+    np.bitwise_or.at(mask, (x+1, y+1), BOTTOM)
+    return mask
@@ -0,0 +1,83 @@
+"""
+Draw snapshots while the simulation is still running
+"""
+import os
+from threading import Thread
+from multiprocessing import Process, Queue, cpu_count
+import numpy as np
+from plot import snap_frame
+
+
+def _render(frames, results, r, edges, output_dir, with_arrows, save_png):
+    """
+    Worker loop: draw frames until told to stop
+    """
+    for seq, i, p, v in iter(frames.get, None):
+        frame = snap_frame(i, p, v, r, edges, output_dir, with_arrows, save_png)
+        if results is not None:
+            results.put((seq, np.array(frame)))
+
+
+class SnapshotPipeline:
+    """
+    Pool of processes that draw logged frames as they come in;
+    frames wait in a bounded queue, so a simulation that runs
+    ahead of the workers blocks until there is room again.
+    With a video, drawn frames are sent back through a queue
+    of the same size and written to it in order, so workers
+    that run ahead of the writer wait for it in turn; PNGs
+    are only saved if save_png is on
+    """
+    def __init__(self, r, edges, output_dir, with_arrows, workers=0, depth=0,
+                 video=None, save_png=True):
+        workers = workers or max(cpu_count()-1, 1)
+        os.makedirs(output_dir, exist_ok=True)
+        depth = depth or 2*workers
+        self.frames = Queue(depth)
+        self.results = Queue(depth) if video is not None else None
+        self.video = video
+        self.workers = [Process(target=_render, args=(self.frames, self.results, r, edges,
+                                                      output_dir, with_arrows, save_png))
+                        for _ in range(workers)]
+        for w in self.workers:
+            w.start()
+        self.writer = None
+        if video is not None:
+            self.writer = Thread(target=self._write)
+            self.writer.start()
+        self.last = -1
+        self.seq = 0
+
+    def _write(self):
+        """
+        Writer thread: put drawn frames into the video in order
+        """
+        pending, seq = {}, 0
+        for k, frame in iter(self.results.get, None):
+            pending[k] = frame
+            while seq in pending:
+                self.video.write(pending.pop(seq))
+                seq += 1
+
+    def put(self, i, p, v):
+        """
+        Hand a frame over to the workers;
+        blocks while the queue is full
+        """
+        self.frames.put((self.seq, i, np.array(p, dtype=np.float64), np.array(v, dtype=np.float64)))
+        self.last = i
+        self.seq += 1
+        return 0
+
+    def close(self):
+        """
+        Wait for the workers to draw what is left
+        """
+        for _ in self.workers:
+            self.frames.put(None)
+        for w in self.workers:
+            w.join()
+        if self.writer:
+            self.results.put(None)
+            self.writer.join()
+        return 0
@@ -2,105 +2,242 @@
 Plot a snapshot of the simulation
 """
 import os
+import numpy as np
 import matplotlib.pyplot as plt
-try:
-    from cv2 import imread
-    runnable = True
-except ModuleNotFoundError:
-    print("W: Failed to import opencv; simulation video generation will be disabled.")
-    RUNNABLE = False
-try:
-    from ffmpegcv import VideoWriter
-    FALLBACK = False
-except ModuleNotFoundError:
-    print("W: Failed to load ffmpegcv; falling back to opencv.")
-    print("W: Simulation video size may become too large; ffmpegcv installation is recommanded")
-    from cv2 import VideoWriter
-    FALLBACK = True
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection, EllipseCollection
+from matplotlib.image import imsave
+from matplotlib.colors import to_rgba
+
+# video backend of this process, see _video()
+_VIDEO = {}
+# maze figure of this process, see _canvas()
+_CANVAS = {}
+
+
+def _canvas(edges):
+    """
+    Figure with the maze already drawn on it, kept around
+    for the whole process and redrawn only for a new maze;
+    mazes are told apart by identity rather than compared
+    every frame, and edges=None stands for the last one
+    """
+    if edges is None or (_CANVAS.get("edges") is edges and _CANVAS["size"] == len(edges)):
+        return _CANVAS
+    lim_x, lim_y = max(x[0][0] for x in edges), max(x[0][1] for x in edges)
+    fig = Figure()
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    ax.set_xticks([])
+    ax.set_yticks([])
+    ax.set_xlim(-.5, lim_x+.5)
+    ax.set_ylim(-.5, lim_y+.5)
+    ax.add_collection(LineCollection(edges, colors='b'))
+    canvas.draw()
+    _CANVAS.update(edges=edges, size=len(edges), canvas=canvas, ax=ax,
+                   background=canvas.copy_from_bbox(fig.bbox))
+    return _CANVAS
+
+
+def use_maze(edges):
+    """
+    Draw the maze for this process ahead of time; as a pool
+    initializer, it sends the maze to each worker once, and
+    the frames handed to the workers then pass edges=None
+    """
+    _canvas(edges)
+    return 0
+
+
+def draw_snap(p, v, r, edges, with_arrows, arrow_scale=.2, e_x=0, e_y=0):
+    """
+    Draw a snapshot of simulation on top of the maze (the one
+    of use_maze() if edges is None); returns the RGBA pixel
+    buffer of the figure
+    """
+    cache = _canvas(edges)
+    canvas, ax = cache["canvas"], cache["ax"]
+    canvas.restore_region(cache["background"])
+    p, v = np.asarray(p, dtype=float).reshape(-1, 2), np.asarray(v, dtype=float).reshape(-1, 2)
+    cols = np.where((e_x-2 < p[:, 0]) & (p[:, 0] < e_x+1) & (p[:, 1]-r < e_y), 'r', 'b')
+    disks = EllipseCollection(2*r, 2*r, 0, units="xy", offsets=p,
+                              offset_transform=ax.transData, facecolors=cols)
+    ax.add_collection(disks, autolim=False)
+    ax.draw_artist(disks)
+    disks.remove()
+    if with_arrows and len(p):
+        arrows = ax.quiver(p[:, 0], p[:, 1], v[:, 0]*arrow_scale, v[:, 1]*arrow_scale,
+                           angles="xy", scale_units="xy", scale=1, units="xy", width=.01,
+                           headwidth=5, headlength=5, headaxislength=5, color='k')
+        ax.draw_artist(arrows)
+        arrows.remove()
+    return canvas.buffer_rgba()
 
 
 def save_snap(i, p, v, r, edges, output_dir, with_arrows, arrow_scale=.2, e_x=0, e_y=0):
     """
     Save a snapshot of simulation
     """
-    lim_x, lim_y = max(x[0][0] for x in edges), max(x[0][1] for x in edges)
     if not os.path.exists(output_dir):
         os.mkdir(output_dir)
-    plt.clf()
-    plt.xticks([])
-    plt.yticks([])
-    plt.xlim(-.5, lim_x+.5)
-    plt.ylim(-.5, lim_y+.5)
-    for e in edges:
-        plt.plot([e[0][0], e[1][0]], [e[0][1], e[1][1]], "b-")
-    for (x, y), (dx, dy) in zip(p, v):
-        dx *= arrow_scale
-        dy *= arrow_scale
-        col = 'b'
-        if e_x-2 < x < e_x+1 and y-r < e_y:
-            col = 'r'
-        circle = plt.Circle((x, y), radius=r, fc=col)
-        plt.gca().add_patch(circle)
-        if with_arrows:
-            plt.arrow(x, y, dx, dy, fc='k', ec='k', head_length=.05, head_width=.05)
-    plt.savefig(os.path.join(output_dir, f"{i}.png"))
+    frame = draw_snap(p, v, r, edges, with_arrows, arrow_scale, e_x, e_y)
+    imsave(os.path.join(output_dir, f"{i}.png"), np.asarray(frame))
     return 0
 
 
-def plot_trace_path(pos, w, r, edges, output_dir):
+def snap_frame(i, p, v, r, edges, output_dir, with_arrows, save_png=True,
+               arrow_scale=.2, e_x=0, e_y=0):
+    """
+    Draw a snapshot and return it as a BGR image for the video,
+    saving it as a PNG as well unless save_png is off; the image
+    is a view of the figure buffer, valid until the next draw
+    """
+    frame = np.asarray(draw_snap(p, v, r, edges, with_arrows, arrow_scale, e_x, e_y))
+    if save_png:
+        if not os.path.exists(output_dir):
+            os.mkdir(output_dir)
+        imsave(os.path.join(output_dir, f"{i}.png"), frame)
+    return frame[:, :, 2::-1]
+
+
+def _density(points, d):
+    """
+    Count, for every point, the other points within d of it
+    along both axes; points are hashed into d/2 wide cells
+    and whole cells are counted, so the box is only exact to
+    within one cell
+    """
+    if not len(points):
+        return np.zeros(0, dtype=np.int64)
+    cell = np.floor(points/(d/2)).astype(np.int64)
+    cell -= cell.min(axis=0) - 2
+    width = int(cell[:, 1].max()) + 3
+    keys, counts = np.unique(cell[:, 0]*width + cell[:, 1], return_counts=True)
+    total = np.zeros(len(points), dtype=np.int64)
+    for dx in range(-2, 3):
+        for dy in range(-2, 3):
+            near = (cell[:, 0]+dx)*width + cell[:, 1]+dy
+            ix = np.minimum(np.searchsorted(keys, near), len(keys)-1)
+            total += np.where(keys[ix] == near, counts[ix], 0)
+    return total - 1
+
+
+def plot_trace_path(path, r, edges, output_dir):
     """
     Plot the path of the particle that solved the maze
     """
     if not os.path.exists(output_dir):
         os.mkdir(output_dir)
-    i = min(p[1] for p in pos[-1] if w-2 < p[0] < w)
-    i = pos[-1].index([x for x in pos[-1] if x[1] == i][0])
     lim_x, lim_y = max(x[0][0] for x in edges), max(x[0][1] for x in edges)
     plt.clf()
     plt.xticks([])
     plt.yticks([])
     plt.xlim(-.5, lim_x+.5)
     plt.ylim(-.5, lim_y+.5)
-    for e in edges:
-        plt.plot([e[0][0], e[1][0]], [e[0][1], e[1][1]], "b-")
+    ax = plt.gca()
+    ax.add_collection(LineCollection(edges, colors='b'))
 
     # change transparency by density of points around every point
-    tp = []
-    for j in range(len(pos)):
-        tp.append((len(pos) - sum(1 if abs(pos[j][i][0]-pos[k][i][0])<3*r and \
-                                  abs(pos[j][i][1]-pos[k][i][1])<3*r and j != k else 0 \
-                                  for k in range(len(pos))))/len(pos))
+    tp = 1 - _density(np.asarray(path, dtype=float).reshape(-1, 2), 3*r)/len(path)
 
     # scale transparency between .1 and .99
-    tp = [(.99-.1)*(x-min(tp))/(max(tp)-min(tp)) + .1 for x in tp]
-    for j in range(len(pos)-1):
-        plt.arrow(pos[j][i][0],
-                  pos[j][i][1],
-                  pos[j+1][i][0]-pos[j][i][0],
-                  pos[j+1][i][1]-pos[j][i][1],
-                  alpha=tp[j],
-                  fc='g',
-                  length_includes_head=True,
-                  head_width=.05)
+    spread = tp.max() - tp.min() if len(tp) else 0
+    tp = (.99-.1)*(tp-tp.min())/spread + .1 if spread else np.full(len(tp), .99)
+    if len(path) > 1:
+        path = np.asarray(path, dtype=float)
+        step = np.diff(path, axis=0)
+        cols = np.tile(to_rgba('g'), (len(step), 1))
+        cols[:, 3] = tp[:-1]
+        ax.quiver(path[:-1, 0], path[:-1, 1], step[:, 0], step[:, 1],
+                  angles="xy", scale_units="xy", scale=1, units="xy", width=.01,
+                  headwidth=5, headlength=7.5, headaxislength=7.5, color=cols)
     plt.savefig(os.path.join(output_dir, "trace.png"), dpi=300)
     return 0
 
 
+def _video():
+    """
+    Load opencv and ffmpegcv the first time a video is made;
+    returns the backend, or None without opencv
+    """
+    if "loaded" not in _VIDEO:
+        _VIDEO["loaded"] = True
+        try:
+            from cv2 import imread
+        except ModuleNotFoundError:
+            print("W: Failed to import opencv; simulation video generation will be disabled.")
+            return None
+        try:
+            from ffmpegcv import VideoWriter
+            fallback = False
+        except ModuleNotFoundError:
+            print("W: Failed to load ffmpegcv; falling back to opencv.")
+            print("W: Simulation video size may become too large; ffmpegcv installation is recommanded")
+            from cv2 import VideoWriter
+            fallback = True
+        _VIDEO.update(imread=imread, writer=VideoWriter, fallback=fallback)
+    return _VIDEO if "writer" in _VIDEO else None
+
+
+def _open_video(fname, wd, ht, fps=20):
+    """
+    Open a video writer for wd x ht BGR frames
+    """
+    video = _video()
+    if not video["fallback"]:
+        return video["writer"](fname, None, fps, (wd, ht), pix_fmt="bgr24")
+    return video["writer"](fname, 0, fps, (wd, ht))
+
+
+class VideoStream:
+    """
+    Simulation video that frames are written into straight
+    from memory; the frame size is taken from the first frame
+    """
+    def __init__(self, fname, fps=20):
+        self.fname = fname
+        self.fps = fps
+        self.video = None
+
+    def write(self, frame):
+        """
+        Append one BGR frame
+        """
+        if self.video is None:
+            if not _video():
+                return 1
+            ht, wd, _ = frame.shape
+            self.video = _open_video(self.fname, wd, ht, self.fps)
+        if _VIDEO["fallback"]:
+            # opencv wants a contiguous image, not a view of the figure buffer
+            frame = np.ascontiguousarray(frame)
+        self.video.write(frame)
+        return 0
+
+    def release(self):
+        """
+        Finish the video
+        """
+        if self.video is not None:
+            self.video.release()
+        return 0
+
+
 def make_video(out):
     """
     Merge all snapshots to create simulation video
     """
-    if not runnable:
+    video = _video()
+    if not video:
         print("E: Failed to import opencv; video generation has been disabled.")
         print("I: Please install python-opencv-headless/python-opencv to enable video generation.")
         return 1
     imgs = sorted([f for f in os.listdir(out) if f.endswith(".png")],
                   key=lambda x: int(x.split('.')[0]))
+    imread = video["imread"]
     ht, wd, _ = imread(f"{out}/{imgs[0]}").shape
-    if not FALLBACK:
-        video = VideoWriter(f"{out}/final_simulation.avi", None, 20, (wd, ht), pix_fmt="bgr24")
-    else:
-        video = VideoWriter(f"{out}/final_simulation.avi", 0, 20, (wd, ht))
+    video = _open_video(f"{out}/final_simulation.avi", wd, ht)
     for img in imgs:
         frame = imread(f"{out}/{img}")
         video.write(frame)
@@ -2,73 +2,67 @@
 EdMD simulation
 """
 import os
-from math import sqrt
+import sys
+import json
+from math import sqrt, floor
+from heapq import heappush, heappop, heapify
+from functools import partial
 from random import uniform
+from time import perf_counter
+import numpy as np
 from initialize import particle_shower
+from maze import RIGHT, LEFT, TOP, BOTTOM, wall_mask
+from trajectory import open_log
+from checkpoint import check_log
 
+# event types, in the order in which simultaneous events are handled
+WALL, PAIR, CROSS, EXIT = 0, 1, 2, 3
 
-def get_bx_pr(n: int) -> tuple:
+
+def exit_cells(walls) -> list:
     """
-    Create wall and pair permutations of disks
+    Cells of the bottom row of the maze with no wall below
+    them, i.e. the ones a particle can leave the maze from
     """
-    walls = [(a, b) for a in range(n) for b in range(2)]
-    pairs = [(a, b) for a in range(n) for b in range(a+1, n)]
-    return walls, pairs
+    return [(int(i), 0) for i in np.flatnonzero(walls[1:-1, 1] & BOTTOM == 0)]
 
 
-def _nearest_wall(i: int, j: int, dxn: int) -> list:
+def _in_mask(walls, i: int, j: int) -> bool:
     """
-    Get edge value for the nearest wall
-    Backend function for fix_delta()
+    Whether a cell is covered by the wall mask; cells
+    beyond it are all outside the maze, with no walls
     """
-    match dxn:
-        case 1:
-            return [((i+1, j), (i+1, j+1)), ((i+1, j+1), (i+1, j))]
-        case 2:
-            return [((i, j), (i, j+1)), ((i, j+1),(i, j))]
-        case 3:
-            return [((i, j+1), (i+1, j+1)), ((i+1, j+1), (i, j+1))]
-        case 4:
-            return [((i, j), (i+1, j)), ((i+1, j), (i, j))]
+    return 0 <= i+1 < walls.shape[0] and 0 <= j+1 < walls.shape[1]
 
 
-def save_log(logfile: str, t: float, i: int, pos: list, vel: list) -> bool:
+def _has_wall(walls, i: int, j: int, side: int) -> bool:
     """
-    Save simulation data in log file
+    Look up one side of a cell in the wall mask
+    Backend function for wall_time() and fix_delta()
     """
-    with open(logfile, 'a') as file:
-        file.write(f"time: {t} i: {i}\n")
-        for p in pos:
-            file.write(f"pos {p[0]} {p[1]}\n")
-        for v in vel:
-            file.write(f"vel {v[0]} {v[1]}\n")
-    return 0
+    if _in_mask(walls, i, j):
+        return bool(walls.item(i+1, j+1) & side)
+    return False
 
 
-def wall_time(pos: list, v: float, r: float, k: int, l: int, edges: list) -> float:
+def wall_time(pos: list, v: float, r: float, l: int, walls, cell: tuple = None) -> float:
     """
     Time before a particle hits a wall
     """
-    x = pos[k][l]
-    i, j = [int(a) for a in pos[k]]
+    x = pos[l]
+    i, j = cell if cell else [int(a) for a in pos]
     if not l:
-        if v > 0:
-            loc = _nearest_wall(i, j, 1)
-        else:
-            loc = _nearest_wall(i, j, 2)
+        side = RIGHT if v > 0 else LEFT
     else:
+        side = TOP if v > 0 else BOTTOM
+    if _has_wall(walls, i, j, side):
         if v > 0:
-            loc = _nearest_wall(i, j, 3)
-        else:
-            loc = _nearest_wall(i, j, 4)
-    if any(a in edges for a in loc):
-        if v > 0:
-            val = (-(x%(-1))-r)/v
+            val = (1-(x-(i, j)[l])-r)/v
             if val > 0:
                 return val
             return abs(val)
         if v < 0:
-            val = ((x%1)-r)/abs(v)
+            val = ((x-(i, j)[l])-r)/abs(v)
             if val > 0:
                 return val
             return abs(val)
@@ -87,24 +81,308 @@ def pair_time(x_a: list, v_a: list, x_b: list, v_b: list, r: float) -> float:
     return -(b_ij + sqrt(upsilon))/dv_2 if b_ij < 0 < upsilon else float("inf")
 
 
-def get_next_event(p: list, v: list, boxs: list, pairs: list, s: float, edges: list) -> tuple:
+def cross_time(pos: list, vel: list, cell: tuple) -> tuple:
     """
-    Find which event happens next
+    Time before a particle moves into a neighbouring maze cell,
+    along with the cell it moves into
     """
-    walls = [wall_time(p, v[k][l], s, k, l, edges) for k, l in boxs]
-    pairs = [pair_time(p[k], v[k], p[l], v[l], s) for k, l in pairs]
-    return min(zip(walls+pairs, range(len(walls+pairs))))
+    step, new = float("inf"), cell
+    for l in range(2):
+        if vel[l] > 0:
+            val = (cell[l]+1-pos[l])/vel[l]
+        elif vel[l] < 0:
+            val = (cell[l]-pos[l])/vel[l]
+        else:
+            continue
+        if val < step:
+            step = max(val, 0)
+            new = (cell[0]+(vel[0] > 0)-(vel[0] < 0), cell[1]) if not l else \
+                  (cell[0], cell[1]+(vel[1] > 0)-(vel[1] < 0))
+    return step, new
 
 
-def get_velocities(pos: list, vel: list, boxs: list, pairs: list, n_ix: int) -> list:
+class EventQueue:
+    """
+    Heap of predicted events; events counts the events handed out
+
+    Every entry carries the collision counters its particles had
+    when it was predicted; entries outdated by a later collision
+    are dropped lazily once they reach the top of the heap.
+    Walls are only known for the cell a particle is in, so each
+    particle also has a cell-crossing event that re-predicts its
+    wall events without touching its pair events; crossings are
+    no longer followed once a particle is beyond the wall mask,
+    where there are no walls left to find.
+    With cell_list set, pairs are only predicted between particles
+    in the same or adjacent maze cells; a crossing then also picks
+    up the particles of the cells that just came into reach.
+    A particle in an exit cell, or in the row below the maze (which
+    can only be reached through an exit), that heads down also gets
+    an exit event, for when it is all the way out; as nothing can
+    stop it on the way without a collision, only that count is checked.
+    Exits are not handed out as events, but kept in exit as
+    (time, particle) for the first one that happens; if that
+    particle is knocked about before its exit comes, the exit
+    is taken back, and the first of the particles then on their
+    way out takes its place.
+    With lazy set, every particle has its own time stamp and
+    p[k] holds its position at stamp[k] rather than at the
+    current time. A queue saved with state() is brought back by
+    passing that as state instead of predicting everything again
+    """
+    def __init__(self, p, v, r, walls, t=0, cell_list=False, lazy=False, state=None):
+        self.r = r
+        self.walls = walls
+        self.cell_list = cell_list
+        self.lazy = lazy
+        self.events = 0
+        self.exits = set(exit_cells(walls))
+        self.exit = None
+        if state is None:
+            self.build(p, v, t)
+        else:
+            self.restore(state)
+
+    def build(self, p, v, t):
+        """
+        Predict all events from scratch
+        """
+        self.heap, self.limit, self.members = [], 0, {}
+        self.stamp = [t]*len(p) if self.lazy else None
+        self.count, self.moves, self.cell = [0]*len(p), [0]*len(p), [None]*len(p)
+        for k in range(len(p)):
+            self.cell[k] = (floor(p[k][0]), floor(p[k][1]))
+            self.members.setdefault(self.cell[k], set()).add(k)
+            self._predict_walls(k, p[k], v[k], t)
+        for a in range(len(p)):
+            for b in self._nearby(a, len(p)):
+                if b > a:
+                    self._predict_pair(a, b, p, v, t)
+        self._compact()
+        return 0
+
+    def state(self):
+        """
+        Everything the queue knows, as arrays; the heap is
+        kept in its order, so that it stays a heap
+        """
+        keys = [(e[1], e[2]) + (e[3] if e[1] == CROSS else (e[3], 0)) + e[4:] for e in self.heap]
+        state = {"times": np.array([e[0] for e in self.heap], dtype=np.float64),
+                 "keys": np.array(keys, dtype=np.int64).reshape(-1, 6),
+                 "count": np.array(self.count, dtype=np.int64),
+                 "moves": np.array(self.moves, dtype=np.int64),
+                 "cell": np.array(self.cell, dtype=np.int64).reshape(-1, 2),
+                 "scalars": np.array([self.limit, self.events], dtype=np.int64),
+                 "exit": np.array(self.exit or [], dtype=np.float64)}
+        if self.lazy:
+            state["stamp"] = np.array(self.stamp, dtype=np.float64)
+        return state
+
+    def restore(self, state):
+        """
+        Bring back a queue saved with state()
+        """
+        self.heap = [(t, kind, a, (b, c) if kind == CROSS else b, c_a, c_b)
+                     for t, (kind, a, b, c, c_a, c_b) in zip(state["times"].tolist(),
+                                                             state["keys"].tolist())]
+        self.count, self.moves = state["count"].tolist(), state["moves"].tolist()
+        self.cell = [tuple(x) for x in state["cell"].tolist()]
+        self.members = {}
+        for k, cell in enumerate(self.cell):
+            self.members.setdefault(cell, set()).add(k)
+        self.limit, self.events = state["scalars"].tolist()
+        self.exit = None
+        if len(state["exit"]):
+            self.exit = (state["exit"][0].item(), int(state["exit"][1]))
+        self.stamp = state["stamp"].tolist() if self.lazy else None
+        return 0
+
+    def update(self, ks, p, v, t):
+        """
+        Re-predict the events of particles whose
+        position or velocity has just changed
+        """
+        for k in ks:
+            self.count[k] += 1
+            self._move_to(k, (floor(p[k][0]), floor(p[k][1])))
+            self._predict_walls(k, p[k], v[k], t)
+        for k in ks:
+            for j in self._nearby(k, len(p)):
+                if j != k and not (j in ks and j < k):
+                    self._predict_pair(min(j, k), max(j, k), p, v, t)
+        if self.exit is not None and self.exit[0] > t and self.exit[1] in ks:
+
+            # the first of the particles on their way out takes its
+            # place, as exits that came after it were dropped; cells
+            # of the queue may run ahead of time t, so they are not used
+            self.exit = None
+            for k in range(len(p)):
+                if self.cell[k] is None or v[k][1] >= 0:
+                    continue
+                x, y = self._at(k, p, v, t, t)
+                if (floor(x), floor(y)) in self.exits or floor(y) == -1:
+                    time = t + max((y+self.r)/-v[k][1], 0)
+                    if self.exit is None or time < self.exit[0]:
+                        self.exit = (time, k)
+        if len(self.heap) > self.limit:
+            self._compact()
+        return 0
+
+    def add(self, ks, p, v, t):
+        """
+        Predict the events of particles that were just added
+        to the end of p or pushed, leaving the others alone
+        """
+        for k in range(len(self.count), len(p)):
+            self.count.append(0)
+            self.moves.append(0)
+            self.cell.append((floor(p[k][0]), floor(p[k][1])))
+            self.members.setdefault(self.cell[k], set()).add(k)
+            if self.lazy:
+                self.stamp.append(t)
+        return self.update(ks, p, v, t)
+
+    def drop(self, ks):
+        """
+        Take particles out of the queue: their events go out
+        of date, and with cell_list set no other particle sees
+        them any more, until add() or update() brings them back
+        """
+        for k in ks:
+            self.count[k] += 1
+            self.members[self.cell[k]].discard(k)
+            self.cell[k] = None
+        return 0
+
+    def in_cells(self, cells):
+        """
+        Particles in any of cells, in order
+        """
+        return sorted(k for c in cells for k in self.members.get(c, ()))
+
+    def put_back(self, time, event, t):
+        """
+        Return an event taken by next_event() to the heap;
+        the exit kept in exit goes back as (EXIT, particle, 0)
+        """
+        if event is None:
+            return 0
+        kind, a, b = event
+        stamp = (self.count[a], self.count[b] if kind == PAIR else self.moves[a])
+        heappush(self.heap, (t+time, kind, a, b)+stamp)
+        if kind == EXIT:
+            self.exit = None
+        else:
+            self.events -= 1
+        return 0
+
+    def next_event(self, p, v, t):
+        """
+        Pop the next valid event; returns its time from now
+        """
+        while self.heap:
+            time, kind, a, b, c_a, c_b = heappop(self.heap)
+            if kind == PAIR:
+                if c_a == self.count[a] and c_b == self.count[b]:
+                    self.events += 1
+                    return time-t, (kind, a, b)
+                continue
+            if kind == EXIT:
+                if c_a == self.count[a] and self.exit is None:
+                    self.exit = (time, a)
+                continue
+            if c_a != self.count[a] or c_b != self.moves[a]:
+                continue
+            if kind == WALL:
+                self.events += 1
+                return time-t, (kind, a, b)
+
+            # crossed into a new cell; see what walls lie ahead from there
+            self.moves[a] += 1
+            old = self.cell[a]
+            self._move_to(a, b)
+            self._predict_walls(a, self._at(a, p, v, time, t), v[a], time)
+            if self.cell_list:
+                reach = {(b[0]+x, b[1]+y) for x in (-1, 0, 1) for y in (-1, 0, 1)}
+                reach -= {(old[0]+x, old[1]+y) for x in (-1, 0, 1) for y in (-1, 0, 1)}
+                for c in reach:
+                    for j in self.members.get(c, ()):
+                        self._predict_pair(min(a, j), max(a, j), p, v, time, t)
+        return float("inf"), None
+
+    def _at(self, k, p, v, t, now):
+        """
+        Position of a particle at time t, given
+        that p holds the positions at time now
+        """
+        if self.lazy:
+            now = self.stamp[k]
+        if now == t:
+            return p[k]
+        return [p[k][0]+v[k][0]*(t-now), p[k][1]+v[k][1]*(t-now)]
+
+    def _nearby(self, k, n):
+        """
+        Particles that k could possibly collide with
+        """
+        if not self.cell_list:
+            return range(n)
+        i, j = self.cell[k]
+        return [b for x in (i-1, i, i+1) for y in (j-1, j, j+1) for b in self.members.get((x, y), ())]
+
+    def _move_to(self, k, cell):
+        """
+        Keep track of which cell a particle is in
+        """
+        if self.cell[k] != cell:
+            if self.cell[k] is not None:
+                self.members[self.cell[k]].discard(k)
+            self.members.setdefault(cell, set()).add(k)
+            self.cell[k] = cell
+
+    def _predict_walls(self, k, pos, vel, t):
+        """
+        Push wall and cell-crossing events of a particle
+        """
+        stamp = (self.count[k], self.moves[k])
+        for l in range(2):
+            val = wall_time(pos, vel[l], self.r, l, self.walls, self.cell[k])
+            if val < float("inf"):
+                heappush(self.heap, (t+val, WALL, k, l)+stamp)
+        val, cell = cross_time(pos, vel, self.cell[k])
+        if val < float("inf") and _in_mask(self.walls, *self.cell[k]):
+            heappush(self.heap, (t+val, CROSS, k, cell)+stamp)
+        if (self.cell[k] in self.exits or self.cell[k][1] == -1) and vel[1] < 0:
+            heappush(self.heap, (t+max((pos[1]+self.r)/-vel[1], 0), EXIT, k, 0)+stamp)
+
+    def _predict_pair(self, a, b, p, v, t, now=None):
+        """
+        Push collision event of a pair of particles;
+        p holds the positions at time now (default: t)
+        """
+        now = t if now is None else now
+        val = pair_time(self._at(a, p, v, t, now), v[a], self._at(b, p, v, t, now), v[b], self.r)
+        if val < float("inf"):
+            heappush(self.heap, (t+val, PAIR, a, b, self.count[a], self.count[b]))
+
+    def _compact(self):
+        """
+        Drop outdated entries once they pile up
+        """
+        self.heap = [e for e in self.heap if e[4] == self.count[e[2]] and \
+                     (e[1] == EXIT or e[5] == (self.count[e[3]] if e[1] == PAIR else self.moves[e[2]]))]
+        heapify(self.heap)
+        self.limit = max(4*len(self.heap), 1024)
+
+
+def get_velocities(pos: list, vel: list, event: tuple) -> list:
     """
     Change velocities after event
     """
-    if n_ix < len(boxs):
-        disk, direction = boxs[n_ix]
-        vel[disk][direction] *= -1
+    kind, a, b = event
+    if kind == WALL:
+        vel[a][b] *= -1
     else:
-        a, b = pairs[n_ix - len(boxs)]
         dx = [pos[b][0]-pos[a][0], pos[b][1]-pos[a][1]]
         x_ij = sqrt(dx[0]**2 + dx[1]**2)
         x_ij = [q/x_ij for q in dx]
@@ -117,7 +395,7 @@ def get_velocities(pos: list, vel: list, boxs: list, pairs: list, n_ix: int) ->
     return vel
 
 
-def fix_delta(pos: list, vel: list, r: float, edges: list, l: int) -> tuple:
+def fix_delta(pos: list, vel: list, r: float, walls, l: int) -> tuple:
     """
     Basically bug fix:
     - there may be disks that didn't collide with wall,
@@ -127,48 +405,40 @@ def fix_delta(pos: list, vel: list, r: float, edges: list, l: int) -> tuple:
     i, j = [int(a) for a in pos]
     if not l:
         if x < i+1 < x+r and vel[l] > 0:
-            loc = _nearest_wall(i, j, 1)
-            if any(a in edges for a in loc):
+            if _has_wall(walls, i, j, RIGHT):
                 vel[l] *= -1
         elif x-r < i < x and vel[l] < 0:
-            loc = _nearest_wall(i, j, 2)
-            if any(a in edges for a in loc):
+            if _has_wall(walls, i, j, LEFT):
                 vel[l] *= -1
         if y < j+1 < y+r and vel[1] == 0:
-            loc = _nearest_wall(i, j, 3)
-            if any(a in edges for a in loc):
+            if _has_wall(walls, i, j, TOP):
                 pos[1] -= r
         elif y-r < j < y and vel[1] == 0:
-            loc = _nearest_wall(i, j, 4)
-            if any(a in edges for a in loc):
+            if _has_wall(walls, i, j, BOTTOM):
                 pos[1] += r
     else:
         if y < j+1 < y+r and vel[l] > 0:
-            loc = _nearest_wall(i, j, 3)
-            if any(a in edges for a in loc):
+            if _has_wall(walls, i, j, TOP):
                 vel[l] *= -1
         elif y-r < j < y and vel[l] < 0:
-            loc = _nearest_wall(i, j, 4)
-            if any(a in edges for a in loc):
+            if _has_wall(walls, i, j, BOTTOM):
                 vel[l] *= -1
         if x < i+1 < x+r and vel[0] == 0:
-            loc = _nearest_wall(i, j, 1)
-            if any(a in edges for a in loc):
+            if _has_wall(walls, i, j, RIGHT):
                 pos[0] -= r
         elif x-r < i < x and vel[0] == 0:
-            loc = _nearest_wall(i, j, 2)
-            if any(a in edges for a in loc):
+            if _has_wall(walls, i, j, LEFT):
                 pos[0] += r
     return pos, vel[l]
 
 
-def pull_apart(pos: list, vel: list, r: float, boxs: list, pairs: list, n_ix: list) -> tuple:
+def pull_apart(pos: list, vel: list, r: float, event: tuple) -> tuple:
     """
     Another bug fix:
     - if, by chance, two disks are overlapping,
       pull them apart
     """
-    a, b = pairs[n_ix - len(boxs)]
+    _, a, b = event
     for k in range(2):
         if pos[a][k] > pos[b][k]:
             pos[a][k] += r
@@ -179,7 +449,25 @@ def pull_apart(pos: list, vel: list, r: float, boxs: list, pairs: list, n_ix: li
     return pos, vel
 
 
-def simulate_step(p, v, r, bx, pr, edges, t, next_e, next_e_i, dt=0):
+def move_all(p: list, v: list, r: float, walls, step: float) -> set:
+    """
+    Move every disk forward by one step;
+    returns the disks that fix_delta() had to touch
+    """
+    changed = set()
+    for k, (pos, vel) in enumerate(zip(p, v)):
+        for l in (0, 1):
+            old, other = vel[l], pos[1-l]
+
+            # fix_delta() works in place on pos and vel
+            fix_delta(pos, vel, r, walls, l)
+            if vel[l] != old or pos[1-l] != other:
+                changed.add(k)
+            pos[l] += vel[l]*step
+    return changed
+
+
+def simulate_step(p, v, r, queue, walls, t, next_e, event, dt=0):
     """
     Run one step of simulation
     """
@@ -188,9 +476,8 @@ def simulate_step(p, v, r, bx, pr, edges, t, next_e, next_e_i, dt=0):
     else:
         next_t = t + next_e
     q = 0
-    v_old = v
     while t+next_e <= next_t:
-        if q > 100 and all(abs(v[k][l]) == abs(v_old[k][l]) for k, l in bx):
+        if q > 100:
 
             # clearly, we're just stuck here, doing nothing,
             # so just skip to next event
@@ -201,100 +488,351 @@ def simulate_step(p, v, r, bx, pr, edges, t, next_e, next_e_i, dt=0):
             step = min(dt, next_e)
         q += 1
         t += step
-        for k, l in bx:
-            p[k], v[k][l] = fix_delta(p[k], v[k], r, edges, l)
-            p[k][l] += v[k][l]*step
-        v = get_velocities(p, v, bx, pr, next_e_i)
-        next_e, next_e_i = get_next_event(p, v, bx, pr, r, edges)
-        if next_e < 0 and next_e_i > len(bx):
-            p, v = pull_apart(p, v, r, bx, pr, next_e_i)
-        v_old = v
+        changed = move_all(p, v, r, walls, step)
+        v = get_velocities(p, v, event)
+        if q > 100:
+
+            # we may have skipped past other events too
+            queue.build(p, v, t)
+        else:
+            queue.update(changed | set(event[1:] if event[0] == PAIR else event[1:2]), p, v, t)
+        next_e, event = queue.next_event(p, v, t)
+        if next_e < 0 and event[0] == PAIR:
+            p, v = pull_apart(p, v, r, event)
     remain_t = next_t - t
-    for k, l in bx:
-        p[k], v[k][l] = fix_delta(p[k], v[k], r, edges, l)
-        p[k][l] += v[k][l]*remain_t
+    queue.update(move_all(p, v, r, walls, remain_t), p, v, next_t)
     t += remain_t
     next_e -= remain_t
-    return p, v, next_e, next_e_i, t
+    return p, v, next_e, event, t
 
 
-def run_simulation(n, p, v, r, edges, n_events, dt, stepsize, out, logfile):
+def jump_step(p, v, r, queue, walls, t, next_e, event, dt):
     """
-    Run Molecular Dynamics simulation
+    Run one step of simulation without sub-stepping:
+    jump straight from one event to the next, only moving the
+    particles that take part in it, and bring every particle
+    up to date once the step is over
+    """
+    next_t = t + dt
+    stamp = queue.stamp
+    while t+next_e <= next_t:
+        t += next_e
+        ks = event[1:] if event[0] == PAIR else event[1:2]
+        for k in ks:
+            p[k][0] += v[k][0]*(t-stamp[k])
+            p[k][1] += v[k][1]*(t-stamp[k])
+            stamp[k] = t
+        v = get_velocities(p, v, event)
+        for k in ks:
+            fix_delta(p[k], v[k], r, walls, 0)
+            fix_delta(p[k], v[k], r, walls, 1)
+        queue.update(set(ks), p, v, t)
+        next_e, event = queue.next_event(p, v, t)
+
+        # overlapping disks get pulled apart right away
+        # instead of colliding backwards in time
+        while next_e < 0 and event[0] == PAIR:
+            for k in event[1:]:
+                p[k][0] += v[k][0]*(t-stamp[k])
+                p[k][1] += v[k][1]*(t-stamp[k])
+                stamp[k] = t
+            p, v = pull_apart(p, v, r, event)
+            queue.update(set(event[1:]), p, v, t)
+            next_e, event = queue.next_event(p, v, t)
+    for k in range(len(p)):
+        p[k][0] += v[k][0]*(next_t-stamp[k])
+        p[k][1] += v[k][1]*(next_t-stamp[k])
+        stamp[k] = next_t
+    next_e -= next_t - t
+    return p, v, next_e, event, next_t
+
+
+def exited(queue, t: float) -> tuple:
     """
-    # find the exit point
-    max_x = max(x[1][0] for x in edges)
+    The particle that left the maze by time t, and when
+    it did, as (time, particle); None if none has yet
+    """
+    return queue.exit if queue.exit is not None and queue.exit[0] <= t else None
 
-    bx, pr = get_bx_pr(n)
 
+class Profiler:
+    """
+    Opt-in counters and timers for the simulation loop
+
+    attach() wraps the methods of the event queue, the log and the
+    step and exit check functions of a run, and swaps fix_delta()
+    and pull_apart() of the engine's module for counting versions
+    until detach(); a run without a profiler runs none of this.
+    Counts are of wall and pair events, fix_delta() corrections,
+    pull_apart() rescues and rebuilds of a stuck step; times are
+    of whole steps, and of the event search, event prediction,
+    logging, exit checks and checkpoints within or between them
+    """
+    def __init__(self):
+        self.counts = dict.fromkeys(("wall", "pair", "fix_delta", "pull_apart", "stuck"), 0)
+        self.times = dict.fromkeys(("step", "search", "predict", "log", "exit", "checkpoint"), 0.)
+        self.depth = dict.fromkeys(self.times, 0)
+        self.patched = []
+        self.start = self.stop = None
+
+    def timed(self, name, func):
+        """
+        Wrap func so that its calls add up in timer name; a call
+        made from within another one of the same timer, such as
+        add() calling update(), is only counted once
+        """
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            self.depth[name] += 1
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.depth[name] -= 1
+                if not self.depth[name]:
+                    self.times[name] += perf_counter() - start
+        return wrapper
+
+    def attach(self, queue, log, render, checkpoint, step, check):
+        """
+        Start profiling a run; returns the step and exit
+        check functions to use instead of the given ones
+        """
+        self.start = perf_counter()
+        search, build, put_back = self.timed("search", queue.next_event), queue.build, queue.put_back
+
+        def next_event(p, v, t):
+            time, event = search(p, v, t)
+            if event is not None:
+                self.counts["pair" if event[0] == PAIR else "wall"] += 1
+            return time, event
+
+        def rebuild(p, v, t):
+            self.counts["stuck"] += 1
+            return build(p, v, t)
+
+        def put_back_event(time, event, t):
+            if event is not None:
+                self.counts["pair" if event[0] == PAIR else "wall"] -= 1
+            return put_back(time, event, t)
+
+        queue.next_event, queue.put_back = next_event, put_back_event
+        queue.build = self.timed("predict", rebuild)
+        queue.update = self.timed("predict", queue.update)
+        queue.add = self.timed("predict", queue.add)
+        log.write = self.timed("log", log.write)
+        if render:
+            render.put = self.timed("log", render.put)
+        if checkpoint:
+            checkpoint.put = self.timed("checkpoint", checkpoint.put)
+
+        module = sys.modules[step.__module__]
+        fix_delta, pull_apart = module.fix_delta, module.pull_apart
+
+        def fix(pos, vel, r, walls, l):
+            if isinstance(pos, np.ndarray):
+                out = fix_delta(pos, vel, r, walls, l)
+                self.counts["fix_delta"] += int(np.count_nonzero(out))
+                return out
+            old = vel[l], pos[1-l]
+            out = fix_delta(pos, vel, r, walls, l)
+            self.counts["fix_delta"] += (vel[l], pos[1-l]) != old
+            return out
+
+        def pull(pos, vel, r, event):
+            self.counts["pull_apart"] += 1
+            return pull_apart(pos, vel, r, event)
+
+        self.patched = [(module, "fix_delta", fix_delta), (module, "pull_apart", pull_apart)]
+        module.fix_delta, module.pull_apart = fix, pull
+        return self.timed("step", step), self.timed("exit", check)
+
+    def detach(self):
+        """
+        Stop profiling; puts the engine's module back as it was
+        """
+        for module, name, func in self.patched:
+            setattr(module, name, func)
+        self.patched = []
+        self.stop = perf_counter()
+        return 0
+
+    def report(self, fname, **info):
+        """
+        Write the counts and times to fname as JSON, along with info
+        """
+        total = (self.stop or perf_counter()) - (self.start or perf_counter())
+        events = self.counts["wall"] + self.counts["pair"]
+        times = dict(self.times)
+        times["move"] = max(times["step"] - times["search"] - times["predict"], 0)
+        times["other"] = max(total - times["step"] - times["log"] - times["exit"]
+                             - times["checkpoint"], 0)
+        data = {**info, "wall_time": total, "events": events,
+                "events_per_s": events/total if total else 0,
+                "counts": self.counts, "times": times}
+        with open(fname, 'w') as file:
+            json.dump(data, file, indent=2)
+        return data
+
+
+def _engine(name: str, edmd: bool = False) -> tuple:
+    """
+    Pick the event queue and step function of an engine,
+    along with its converters from lists to state and back
+    """
+    if name == "numpy":
+
+        # imported here since vectorized builds on this module
+        import vectorized
+        return (vectorized.ArrayEvents, vectorized.jump_step if edmd else vectorized.simulate_step,
+                vectorized.to_state, vectorized.to_list)
+    if edmd:
+        return partial(EventQueue, lazy=True), jump_step, list, list
+    return EventQueue, simulate_step, list, list
+
+
+def _start(p, v, r, walls, out, cell_list, queue_type, to_state, resume=None):
+    """
+    Set up the state of a run: from scratch, clearing the output
+    directory, or from the state of a checkpoint in resume
+    (see checkpoint.resume_state())
+    """
+    if resume is not None:
+        p, v = to_state(resume["pos"].tolist()), to_state(resume["vel"].tolist())
+        queue = queue_type(p, v, r, walls, resume["t"], cell_list, state=resume["queue"])
+        return resume["t"], resume["i"], p, v, queue, resume["next_e"], resume["event"]
     if os.path.isdir(out):
         print("I: Output directory already exists, deleting any files within it...")
         for file in os.listdir(out):
             os.remove(f"{out}/{file}")
-    t, i = 0, 0
-
-    next_e, next_e_i = get_next_event(p, v, bx, pr, r, edges)
-    save_log(logfile, t, i, p, v)
-    i += 1
-    for _ in range(n_events):
-        p, v, next_e, next_e_i, t = simulate_step(p, v, r, bx, pr, edges, t, next_e, next_e_i, dt)
-
-        if not i%stepsize:
-            save_log(logfile, t, i//stepsize, p, v)
-        i += 1
-        if not i%(stepsize//10):
-            print(f"\033[KI: Simulating timestep {t:.5f} s\r", end='', flush=True)
-
-        # check if any particle has reached the exit
-        for pos in p:
-            if max_x-2 < pos[0] < max_x+1 and pos[1]+r < 0:
-                print(f"\nI: Timestep {t:.5f}; a particle solved the maze! Halting")
-                return t, p, v, 1
-    print(f"\nI: Finished simulation for {t} timesteps")
-    return t, p, v, 0
+    p, v = to_state(p), to_state(v)
+    queue = queue_type(p, v, r, walls, 0, cell_list)
+    next_e, event = queue.next_event(p, v, 0)
+    return 0, 0, p, v, queue, next_e, event
 
 
-def simulation_with_fan(n, orig_n, p, v, r, edges, n_events, fan_speed, height, dt, stepsize, out, logfile):
+def run_simulation(n, p, v, r, edges, n_events, dt, stepsize, out, logfile, cell_list=False,
+                   engine="list", edmd=False, render=None, checkpoint=None, resume=None,
+                   profile=None, log_budget=0, compress=None, walls=None):
     """
-    Run Molecular Dynamics simulation with pressure gradient
+    Run Molecular Dynamics simulation; checkpoint (a Checkpointer)
+    saves the state of the run every few log frames, and resume
+    picks a run up from such a state. A Profiler in profile is
+    attached to the run; detaching it is up to the caller. With
+    log_budget (bytes), older log frames are thinned out to keep
+    the log within it; with compress ('zlib' or 'lzma'), a new
+    log is written compressed. walls is the wall mask of edges,
+    worked out here if not given
     """
-    # find the exit point
-    max_x = max(x[1][0] for x in edges)
+    if resume is not None:
+        walls = resume["walls"]
+    elif walls is None:
+        walls = wall_mask(edges)
+    queue_type, step, to_state, to_list = _engine(engine, edmd)
+    check = exited
+    if edmd:
+
+        # every step now spans a whole log frame
+        dt, n_events, stepsize = dt*stepsize, n_events//stepsize, 1
+
+    t, i, p, v, queue, next_e, event = _start(p, v, r, walls, out, cell_list, queue_type,
+                                              to_state, resume)
+    with open_log(logfile, None if resume is None else resume["frame"], log_budget,
+                  compress) as log:
+        check_log(log, resume, logfile)
+        if profile:
+            step, check = profile.attach(queue, log, render, checkpoint, step, check)
+        if resume is None:
+            log.write(t, i, p, v)
+            if render:
+                render.put(i, p, v)
+            i += 1
+        for _ in range(n_events-i+1):
+            p, v, next_e, event, t = step(p, v, r, queue, walls, t, next_e, event, dt)
+
+            if not i%stepsize:
+                log.write(t, i//stepsize, p, v)
+                if render:
+                    render.put(i//stepsize, p, v)
+            i += 1
+            if not i%max(stepsize//10, 1):
+                print(f"\033[KI: Simulating timestep {t:.5f} s\r", end='', flush=True)
+
+            # the queue keeps track of particles leaving through the exit
+            if check(queue, t):
+                print(f"\nI: Timestep {t:.5f}; particle {queue.exit[1]} solved the maze "
+                      f"at {queue.exit[0]:.5f} s! Halting")
+                return t, to_list(p), to_list(v), queue.exit, queue.events
+            if checkpoint and not (i-1)%stepsize:
+                checkpoint.put((i-1)//stepsize, t, i, p, v, n, next_e, event, queue, log)
+    print(f"\nI: Finished simulation for {t} timesteps")
+    return t, to_list(p), to_list(v), None, queue.events
 
-    bx, pr = get_bx_pr(n)
 
-    if os.path.isdir(out):
-        print("I: Output directory already exists, deleting any files within it...")
-        for file in os.listdir(out):
-            os.remove(f"{out}/{file}")
-    t, i = 0, 0
-
-    next_e, next_e_i = get_next_event(p, v, bx, pr, r, edges)
-    save_log(logfile, t, i, p, v)
-    i += 1
-    for _ in range(n_events):
-        p, v, next_e, next_e_i, t = simulate_step(p, v, r, bx, pr, edges, t, next_e, next_e_i, dt)
-
-        if not i%stepsize:
-            save_log(logfile, t, i//stepsize, p, v)
-
-            # add new particles to the mix
-            if uniform(0, 1) < fan_speed/10:
-                p, v = particle_shower(p, v, r, height, orig_n)
-                n = len(p)
-                bx, pr = get_bx_pr(n)
-                next_e, next_e_i = get_next_event(p, v, bx, pr, r, edges)
-        i += 1
-
-        # //13 (or any other prime number, I guess) makes the output look more...busy :P
-        if not i%(stepsize//13):
-            print(f"\033[KI: Simulating timestep {t:.5f} s ({n} particles)\r", end='', flush=True)
-
-        # check if any particle has reached the exit
-        for pos in p:
-            if max_x-2 < pos[0] < max_x+1 and pos[1]+r < 0:
-                print(f"\nI: Timestep {t:.5f}; a particle solved the maze! Halting")
-                return t, p, v, n, 1
+def simulation_with_fan(n, orig_n, p, v, r, edges, n_events, fan_speed, height, dt, stepsize, out, logfile,
+                        cell_list=False, engine="list", edmd=False, render=None, checkpoint=None,
+                        resume=None, profile=None, log_budget=0, compress=None, walls=None):
+    """
+    Run Molecular Dynamics simulation with pressure gradient;
+    checkpoint, resume, profile, log_budget, compress and walls
+    work as in run_simulation()
+    """
+    if resume is not None:
+        walls = resume["walls"]
+    elif walls is None:
+        walls = wall_mask(edges)
+    queue_type, step, to_state, to_list = _engine(engine, edmd)
+    check = exited
+    if edmd:
+
+        # every step now spans a whole log frame
+        dt, n_events, stepsize = dt*stepsize, n_events//stepsize, 1
+
+    t, i, p, v, queue, next_e, event = _start(p, v, r, walls, out, cell_list, queue_type,
+                                              to_state, resume)
+    with open_log(logfile, None if resume is None else resume["frame"], log_budget,
+                  compress) as log:
+        check_log(log, resume, logfile)
+        if profile:
+            step, check = profile.attach(queue, log, render, checkpoint, step, check)
+        if resume is None:
+            log.write(t, i, p, v)
+            if render:
+                render.put(i, p, v)
+            i += 1
+        for _ in range(n_events-i+1):
+            p, v, next_e, event, t = step(p, v, r, queue, walls, t, next_e, event, dt)
+
+            if not i%stepsize:
+                log.write(t, i//stepsize, p, v)
+                if render:
+                    render.put(i//stepsize, p, v)
+
+                # add new particles to the mix
+                if uniform(0, 1) < fan_speed/10:
+                    # only the entry cell and the one below it can be in the way
+                    p, v, k = particle_shower(to_list(p), to_list(v), r, height, orig_n,
+                                              queue.in_cells([(0, height), (0, height-1)]))
+                    p, v = to_state(p), to_state(v)
+                    n = len(p)
+
+                    # only the new or pushed particle needs new events
+                    if k is not None:
+                        queue.put_back(next_e, event, t)
+                        queue.add([k], p, v, t)
+                        next_e, event = queue.next_event(p, v, t)
+            i += 1
+
+            # //13 (or any other prime number, I guess) makes the output look more...busy :P
+            if not i%max(stepsize//13, 1):
+                print(f"\033[KI: Simulating timestep {t:.5f} s ({n} particles)\r", end='', flush=True)
+
+            # the queue keeps track of particles leaving through the exit
+            if check(queue, t):
+                print(f"\nI: Timestep {t:.5f}; particle {queue.exit[1]} solved the maze "
+                      f"at {queue.exit[0]:.5f} s! Halting")
+                return t, to_list(p), to_list(v), n, queue.exit, queue.events
+            if checkpoint and not (i-1)%stepsize:
+                checkpoint.put((i-1)//stepsize, t, i, p, v, n, next_e, event, queue, log)
 
     print(f"\nI: Finished simulation for {t} timesteps")
-    return t, p, v, n, 0
+    return t, to_list(p), to_list(v), n, None, queue.events
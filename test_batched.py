@@ -0,0 +1,22 @@
+"""
+Tests for the batched engine
+"""
+import numpy as np
+from maze import maze_walls
+from batched import run_batch
+from test_simulate import R
+
+
+def test_exits():
+    np.random.seed(0)
+    edges, walls = maze_walls(4)
+
+    # a lone disk leaves with nothing left to collide with
+    exit_t, _ = run_batch([[[3.5, 0.5]]], [[[0., -1.]]], R, edges, 20000, 5e-5, 200, walls)
+    assert abs(exit_t[0]-0.6) < 1e-9
+
+    # disk 0 is half out already, and its next crossing takes it further down
+    p = [[[3.85, 0.05], [0.5, 2.5]]]*2
+    v = [[[0.5, -1.], [40., 0.]], [[0.5, -1.], [1., 0.3]]]
+    exit_t, _ = run_batch(p, v, R, edges, 20000, 5e-5, 200, walls)
+    assert np.allclose(exit_t, 0.15)
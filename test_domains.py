@@ -0,0 +1,87 @@
+"""
+Tests for the domain-decomposed mode
+"""
+import random
+import numpy as np
+from maze import maze_walls, wall_mask
+from domains import Domains
+from simulate import EventQueue, jump_step
+
+R = 0.05
+
+
+def single(p, v, walls, until, dt):
+    """
+    The same run in one process, as --edmd with --cell_list
+    """
+    p, v = [x[:] for x in p], [x[:] for x in v]
+    queue = EventQueue(p, v, R, walls, 0, cell_list=True, lazy=True)
+    next_e, event = queue.next_event(p, v, 0)
+    t = 0
+    while t < until-1e-12:
+        p, v, next_e, event, t = jump_step(p, v, R, queue, walls, t, next_e, event, dt)
+    return np.array(p), np.array(v), queue.events
+
+
+def split(p, v, edges, walls, until, dt):
+    """
+    The run on two strips, cut at x = 2
+    """
+    domains = Domains(np.array(p), np.array(v), R, edges, 2, walls)
+    try:
+        t = 0
+        while t < until-1e-12:
+            t = domains.advance(t, dt)
+        p, v = (x.copy() for x in domains.state())
+        return p, v, domains.events
+    finally:
+        domains.close()
+
+
+def test_boundary_collisions():
+    np.random.seed(1)
+    random.seed(1)
+    edges, walls = maze_walls(4)
+
+    # disks packed around the cut between the two strips
+    p = [[1.25+0.5*(k%4)+0.1*np.random.rand(), 0.3+0.8*(k//4)+0.1*np.random.rand()]
+         for k in range(16)]
+    v = np.random.randn(16, 2).tolist()
+    p_1, v_1, events_1 = single(p, v, walls, 1., .01)
+    p_2, v_2, events_2 = split(p, v, edges, walls, 1., .01)
+
+    # collisions across the cut count once on either side
+    assert events_2 > events_1
+    assert np.allclose(p_1, p_2, atol=1e-9) and np.allclose(v_1, v_2, atol=1e-9)
+
+
+def test_collision_turns_disk():
+    # an open box, where every disk starts with v_x = 0: disk 1 rests
+    # beyond the halo of the left strip, is turned towards it by disk 0,
+    # and runs across the cut into disk 2, out of reach of the right strip
+    edges = [((0, 0), (0, 4)), ((4, 0), (4, 4)), ((0, 0), (3, 0)), ((0, 4), (4, 4))]
+    walls = wall_mask(edges)
+    s = 2*R/np.sqrt(2)
+    p = [[3.5, 0.3], [3.5-s-0.01, 0.3+s+0.03]]
+    v = [[0., 6.], [0., 0.]]
+    mid, _, _ = single(p, v, walls, .9, .9)
+    p.append(mid[1].tolist())
+    v.append([0., 0.])
+    p_1, v_1, _ = single(p, v, walls, 1., 1.)
+    p_2, v_2, _ = split(p, v, edges, walls, 1., 1.)
+    assert np.allclose(p_1, p_2, atol=1e-9) and np.allclose(v_1, v_2, atol=1e-9)
+
+
+def test_collision_speeds_disk_up():
+    # disk 1 knocks disk 0, beyond the halo of the left strip, into
+    # running left at sqrt(2) times the speed of any disk at the start,
+    # and on into disk 2, owned by the left strip, within one window
+    # sized by the fastest disk alone
+    edges = [((0, 0), (0, 4)), ((4, 0), (4, 4)), ((0, 0), (3, 0)), ((0, 4), (4, 4))]
+    walls = wall_mask(edges)
+    a, d = [3.001, 2.], (2*R+1e-4)/np.sqrt(2)
+    p = [a, [a[0]+d, a[1]+d], [1.999, 2.]]
+    v = [[-np.sqrt(.5), np.sqrt(.5)], [-np.sqrt(.5), -np.sqrt(.5)], [1., 0.]]
+    p_1, v_1, _ = single(p, v, walls, 1., 1.)
+    p_2, v_2, _ = split(p, v, edges, walls, 1., 1.)
+    assert np.allclose(p_1, p_2, atol=1e-9) and np.allclose(v_1, v_2, atol=1e-9)
@@ -0,0 +1,18 @@
+"""
+Tests for the ensemble runner
+"""
+from ensemble import replicas, run_batched, run_ensemble
+
+
+def test_batched_rows_name_their_maze(tmp_path):
+    reps = replicas([4], [3], [3], [0], [5, 6, 7])
+    rows = run_batched(reps, str(tmp_path), 200, stepsize=100)
+    assert [x["seed"] for x in rows] == [5, 6, 7]
+    assert [x["maze_seed"] for x in rows] == [5, 5, 5]
+
+
+def test_batched_warns_about_ignored_options(tmp_path, capsys):
+    reps = replicas([4], [3], [3], [0], [5])
+    rows = run_ensemble(reps, str(tmp_path), 200, 1, True, stepsize=100, cell_list=True)
+    assert "W: Batched replicas" in capsys.readouterr().out
+    assert rows[0]["maze_seed"] == 5
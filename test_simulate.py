@@ -0,0 +1,74 @@
+"""
+Tests for the list engine and its profiler
+"""
+import numpy as np
+import simulate
+from maze import maze_walls
+from simulate import EventQueue, Profiler, simulate_step, jump_step, exited
+
+R = 0.1
+
+
+def small_maze():
+    """
+    A 4x4 maze; its exit is always below cell (3, 0)
+    """
+    np.random.seed(0)
+    return maze_walls(4)[1]
+
+
+def run(p, v, edmd, until=1., dt=5e-5):
+    """
+    Run the list engine until a disk leaves the maze, or until
+    time until; returns the exit and the positions at the end
+    """
+    walls = small_maze()
+    queue = EventQueue(p, v, R, walls, 0, lazy=edmd)
+    step = jump_step if edmd else simulate_step
+    dt = dt*200 if edmd else dt
+    next_e, event = queue.next_event(p, v, 0)
+    t = 0
+    while t < until and not exited(queue, t):
+        p, v, next_e, event, t = step(p, v, R, queue, walls, t, next_e, event, dt)
+    return queue.exit, p
+
+
+def test_single_disk_leaves():
+    # nothing is left to collide with once the disk is out
+    for edmd in (False, True):
+        out, _ = run([[3.5, 0.5]], [[0., -1.]], edmd)
+        assert out is not None
+        assert out[1] == 0 and abs(out[0]-0.6) < 1e-9
+
+
+def test_exit_after_bounce_half_out():
+    # with dt sub-stepping, fix_delta() bounces disk 0 off a side of the
+    # exit while it is already half out, so its exit is predicted again
+    # from the row below the maze
+    for edmd in (False, True):
+        out, _ = run([[3.85, 0.05], [0.5, 2.5]], [[0.5, -1.], [40., 0.]], edmd)
+        assert out is not None and out[1] == 0
+        assert abs(out[0]-0.15) < 1e-3
+
+
+def test_profiler_counts_nested_calls_once(monkeypatch):
+    # a clock that goes up by one every time it is read
+    clock = iter(range(100))
+    monkeypatch.setattr(simulate, "perf_counter", lambda: next(clock))
+    profile = Profiler()
+    update = profile.timed("predict", lambda: 0)
+    add = profile.timed("predict", update)
+    add()
+    assert profile.times["predict"] == 2
+
+
+def test_exit_taken_back_when_disk_turns():
+    # disk 0 is due out first, but is turned back at t = 0.1
+    walls = small_maze()
+    p, v = [[3.3, 0.5], [3.7, 0.6]], [[0., -1.], [0., -1.]]
+    queue = EventQueue(p, v, R, walls, 0)
+    queue.next_event(p, v, 0)
+    assert queue.exit == (0.6, 0)
+    p, v = [[3.3, 0.4], [3.7, 0.5]], [[0., 1.], [0., -1.]]
+    queue.update({0}, p, v, 0.1)
+    assert queue.exit[1] == 1 and abs(queue.exit[0]-0.7) < 1e-9
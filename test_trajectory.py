@@ -0,0 +1,53 @@
+"""
+Tests for the trajectory log
+"""
+import os
+import numpy as np
+from trajectory import open_log, read_paths
+
+
+def write(fname, pos, until=None):
+    """
+    Log one frame per row of pos, numbered from 0,
+    dropping the frames above until first
+    """
+    with open_log(fname, until) as log:
+        for i, p in enumerate(pos):
+            if until is None or i > until:
+                log.write(i*.1, i, p, np.zeros_like(p))
+
+
+def test_paths_follow_log_of_same_size(tmp_path):
+    fname = str(tmp_path/"run.log")
+    pos = np.arange(12, dtype=np.float64).reshape(3, 2, 2)
+    write(fname, pos)
+    assert np.array_equal(read_paths(fname, [1])[1][1], pos[:, 1])
+
+    # a resumed run writes the same number of frames again
+    size = os.path.getsize(fname)
+    write(fname, pos+1, until=0)
+    assert os.path.getsize(fname) == size
+    expected = np.concatenate((pos[:1, 1], pos[1:, 1]+1))
+    assert np.array_equal(read_paths(fname, [1])[1][1], expected)
+
+
+def test_budget_keeps_log_bounded(tmp_path):
+    fname = str(tmp_path/"run.log")
+    pos = np.random.default_rng(0).uniform(0, 4, (2000, 4, 2))
+    with open_log(fname, budget=4000) as log:
+        for i, p in enumerate(pos):
+            log.write(i*.1, i, p, np.zeros_like(p))
+            assert log.file.tell() <= 4000
+    assert read_paths(fname, [0])[0][1][-1].tolist() == pos[-1, 0].tolist()
+
+
+def test_log_past_budget_stops(tmp_path, capsys):
+    fname = str(tmp_path/"run.log")
+    pos = np.zeros((50, 40, 2))
+    with open_log(fname, budget=1000) as log:
+        for i, p in enumerate(pos):
+            log.write(i*.1, i, p, p)
+        size = log.file.tell()
+        log.write(5., 50, pos[0], pos[0])
+        assert log.file.tell() == size
+    assert capsys.readouterr().out.count("W: The log no longer fits") == 1
@@ -0,0 +1,66 @@
+"""
+Tests for the NumPy engine
+"""
+import numpy as np
+from vectorized import ArrayEvents, simulate_step, jump_step, to_state
+from simulate import exited
+from test_simulate import R, small_maze
+
+
+def run(p, v, edmd, until=1., dt=5e-5):
+    """
+    Run the NumPy engine until a disk leaves the maze, or
+    until time until; returns the exit and the positions
+    """
+    walls = small_maze()
+    p, v = to_state(p), to_state(v)
+    table = ArrayEvents(p, v, R, walls, 0)
+    step = jump_step if edmd else simulate_step
+    dt = dt*200 if edmd else dt
+    next_e, event = table.next_event(p, v, 0)
+    t = 0
+    while t < until and not exited(table, t):
+        p, v, next_e, event, t = step(p, v, R, table, walls, t, next_e, event, dt)
+    return table.exit, p
+
+
+def test_exit_found_after_crossing_out():
+    # by its first event, disk 0 has already crossed out of the maze
+    for edmd in (False, True):
+        out, _ = run([[3.85, 0.05], [0.5, 2.5]], [[0.5, -1.], [1., 0.3]], edmd)
+        assert out is not None and out[1] == 0
+        assert abs(out[0]-0.15) < 1e-9
+
+
+def test_single_disk_leaves():
+    # nothing is left to collide with once the disk is out
+    for edmd in (False, True):
+        out, _ = run([[3.5, 0.5]], [[0., -1.]], edmd)
+        assert out is not None
+        assert out[1] == 0 and abs(out[0]-0.6) < 1e-9
+
+
+def test_exit_taken_back_when_disk_turns():
+    # disk 0 is due out first, but is turned back at t = 0.1
+    p, v = to_state([[3.3, 0.5], [3.7, 0.6]]), to_state([[0., -1.], [0., -1.]])
+    table = ArrayEvents(p, v, R, small_maze(), 0)
+    table.next_event(p, v, 0)
+    assert table.exit[1] == 0 and abs(table.exit[0]-0.6) < 1e-9
+    p, v = to_state([[3.3, 0.4], [3.7, 0.5]]), to_state([[0., 1.], [0., -1.]])
+    table.update({0}, p, v, 0.1)
+    assert table.exit[1] == 1 and abs(table.exit[0]-0.7) < 1e-9
+
+
+def test_soonest_pairs_follow_table():
+    # the soonest time of every row is kept up to date event by event
+    rng = np.random.default_rng(1)
+    walls = small_maze()
+    p = to_state([[i+.5, j+.5] for i in range(4) for j in range(4)]) + rng.uniform(-.3, .3, (16, 2))
+    v = rng.normal(0, 1, (16, 2))
+    table = ArrayEvents(p, v, R, walls, 0)
+    next_e, event = table.next_event(p, v, 0)
+    t = 0
+    for _ in range(100):
+        p, v, next_e, event, t = jump_step(p, v, R, table, walls, t, next_e, event, 0.05)
+        assert np.array_equal(table.soon, table.pairs.min(axis=1))
+        assert np.array_equal(table.soon, table.pairs[np.arange(16), table.mate])
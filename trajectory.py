@@ -0,0 +1,539 @@
+"""
+Binary trajectory log
+
+Layout (little-endian):
+    header: magic (8 bytes), number of frames (u8), offset of frame index (u8)
+    frames: time (f8), frame number (i8), particle count n (i8),
+            positions (n x 2 f8), velocities (n x 2 f8)
+    index:  offset of every frame (u8), written when the log is closed
+The position and velocity blocks of a frame can be mapped directly
+with numpy.memmap; a log whose run crashed before it was closed has
+no index, and its frames are found by walking the frame headers
+
+A log can be given a size budget, see TrajectoryWriter; it then keeps
+recent frames at full resolution and thins out older ones, and saves
+a track of where every particle went in a .track file next to it.
+Logs can also be kept compressed, see compressed.py; they are read
+through the same functions.
+
+The first time the history of a particle is asked for, the positions
+in the log are written particle by particle into a .paths file next
+to it, so that from then on it is a single read (see read_paths()),
+until the log changes, as told by its size and modification time.
+Particles keep their index for the whole run, since new ones are
+only ever added at the end, so a particle's column runs from the
+first frame it shows up in to the last frame of the log:
+    header: magic (8 bytes), size of the log (u8), modification time
+            of the log (u8, ns), codec (u8, 0 for none), number of
+            frames F (u8), number of particles N (u8)
+    frames: times (F f8), frame numbers (F i8)
+    firsts: first frame of every particle (N u8)
+    table:  offset and size of every column (N x 2 u8)
+    columns: positions of every particle from its first frame on
+             ((F - first) x 2 f8 each); NaN where it is missing.
+             The columns of a compressed log are compressed with
+             its codec, see compressed.pack_column()
+"""
+import os
+import struct
+from math import log2
+from itertools import islice
+import numpy as np
+from compressed import (CompressedWriter, is_compressed, read_chunks, read_packed,
+                        pack_column, unpack_column)
+
+MAGIC = b"MAZETRJ1"
+HEADER = struct.Struct("<8sQQ")
+FRAME = struct.Struct("<dqq")
+PATHS = b"MAZEPTH2"
+PATHS_HEADER = struct.Struct("<8sQQQQQ")
+# positions held in memory at once while writing the .paths file
+BLOCK = 1 << 22
+# size of a .track file without frames or waypoints, rounded up
+TRACK = 1024
+
+
+def is_trajectory(fname):
+    """
+    Check whether a file is a binary trajectory log
+    """
+    if not os.path.exists(fname) or os.path.getsize(fname) < HEADER.size:
+        return False
+    with open(fname, 'rb') as file:
+        return file.read(len(MAGIC)) == MAGIC
+
+
+def _scan(file, start, end):
+    """
+    Walk the frame headers to find frame offsets
+    """
+    offsets = []
+    while start + FRAME.size <= end:
+        file.seek(start)
+        _, _, n = FRAME.unpack(file.read(FRAME.size))
+        if start + FRAME.size + 32*n > end:
+            break
+        offsets.append(start)
+        start += FRAME.size + 32*n
+    return offsets, start
+
+
+def read_index(fname):
+    """
+    Get the offset of every frame in a trajectory log
+    """
+    with open(fname, 'rb') as file:
+        magic, count, index = HEADER.unpack(file.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f"{fname} is not a trajectory log")
+        if index:
+            file.seek(index)
+            return np.frombuffer(file.read(8*count), dtype="<u8").tolist()
+        return _scan(file, HEADER.size, os.path.getsize(fname))[0]
+
+
+def read_frame(fname, offset):
+    """
+    Read one frame; positions and velocities are
+    memory-mapped rather than loaded
+    """
+    with open(fname, 'rb') as file:
+        file.seek(offset)
+        t, i, n = FRAME.unpack(file.read(FRAME.size))
+    if not n:
+        return t, i, np.zeros((0, 2)), np.zeros((0, 2))
+    data = np.memmap(fname, dtype="<f8", mode='r', offset=offset+FRAME.size, shape=(2, n, 2))
+    return t, i, data[0], data[1]
+
+
+def _read_text(fname):
+    """
+    Go through the frames of a plain text log one by one
+    """
+    with open(fname, 'r') as file:
+        t, i, p, v = None, 0, [], []
+        for line in file:
+            if line.startswith("time"):
+                if t is not None:
+                    yield t, i, np.array(p).reshape(-1, 2), np.array(v).reshape(-1, 2)
+                _, t, _, i = line.split(' ')
+                t, i, p, v = float(t), int(i), [], []
+            elif line.startswith("pos"):
+                p.append([float(x) for x in line.rstrip().split(' ')[1:]])
+            elif line.startswith("vel"):
+                v.append([float(x) for x in line.rstrip().split(' ')[1:]])
+        if t is not None:
+            yield t, i, np.array(p).reshape(-1, 2), np.array(v).reshape(-1, 2)
+
+
+def read_frames(fname, start=0, stop=None, step=1):
+    """
+    Go through the frames of a simulation log one by one,
+    as (time, frame number, positions, velocities);
+    start, stop and step pick frames like a slice does.
+    Compressed and plain text logs are read as well, the
+    latter only from the start
+    """
+    if is_compressed(fname):
+        yield from read_packed(fname, start, stop, step)
+        return
+    if not is_trajectory(fname):
+        yield from islice(_read_text(fname), start, stop, step)
+        return
+    for offset in read_index(fname)[start:stop:step]:
+        yield read_frame(fname, offset)
+
+
+def last_frame(fname):
+    """
+    Get the last frame of a simulation log
+    """
+    frame = None
+    for frame in read_frames(fname, -1 if is_trajectory(fname) or is_compressed(fname) else 0):
+        pass
+    return frame
+
+
+def write_paths(fname):
+    """
+    Write the positions of a log particle by particle into
+    its .paths file; the log is read one block of frames
+    at a time, and every block is written out column by
+    column. Columns of a compressed log are compressed too
+    """
+    # the log as it was before reading it, so that a change
+    # made while the file is written shows up as one
+    stat = os.stat(fname)
+    times, numbers, counts = [], [], []
+    for t, i, pos, _ in read_frames(fname):
+        times.append(t)
+        numbers.append(i)
+        counts.append(len(pos))
+    n_frames, n = len(counts), max(counts, default=0)
+    counts = np.array(counts, dtype=np.int64)
+    # the first frame with more than k particles; counts only
+    # ever go up in a run, but their running maximum always does
+    firsts = np.searchsorted(np.maximum.accumulate(counts), np.arange(n), side='right')
+    sizes = 16*(n_frames - firsts)
+    codec = read_chunks(fname)[0] if is_compressed(fname) else 0
+
+    # plain columns go straight into place; compressed ones are
+    # laid out plain in a scratch file first
+    start = PATHS_HEADER.size + 16*n_frames + 24*n
+    columns = start + np.concatenate(([0], np.cumsum(sizes)))
+    tmp = f"{fname}.paths.tmp"
+    packed = []
+    with open(f"{tmp}.raw" if codec else tmp, 'w+b') as file:
+        file.truncate(int(columns[-1]))
+        size = max(BLOCK//max(n, 1), 1)
+        for lo in range(0, n_frames, size):
+            block = np.full((min(size, n_frames-lo), n, 2), np.nan, dtype="<f8")
+            for j, (_, _, pos, _) in enumerate(read_frames(fname, lo, lo+len(block))):
+                block[j, :len(pos)] = pos
+            for k in range(n):
+                skip = max(firsts[k]-lo, 0)
+                if skip < len(block):
+                    file.seek(int(columns[k]) + 16*(lo+skip-firsts[k]))
+                    file.write(block[skip:, k].tobytes())
+        if codec:
+            for k in range(n):
+                file.seek(int(columns[k]))
+                packed.append(pack_column(codec, np.frombuffer(file.read(int(sizes[k])), dtype="<f8")))
+            sizes = np.array([len(x) for x in packed], dtype=np.int64)
+            columns = start + np.concatenate(([0], np.cumsum(sizes)))
+    if codec:
+        os.remove(f"{tmp}.raw")
+    with open(tmp, 'wb' if codec else 'r+b') as file:
+        file.write(PATHS_HEADER.pack(PATHS, stat.st_size, stat.st_mtime_ns, codec, n_frames, n))
+        file.write(np.array(times, dtype="<f8").tobytes())
+        file.write(np.array(numbers, dtype="<i8").tobytes())
+        file.write(firsts.astype("<u8").tobytes())
+        file.write(np.stack((columns[:-1], sizes), axis=-1).astype("<u8").tobytes())
+        for data in packed:
+            file.write(data)
+    os.replace(tmp, f"{fname}.paths")
+    return 0
+
+
+def read_paths(fname, ids):
+    """
+    Get the positions of particles ids over the whole of a log
+    as {particle: (first frame, (frames x 2) positions)}, one
+    read per particle; the .paths file is written again first
+    if it is missing or the log has changed since
+    """
+    paths = f"{fname}.paths"
+    header = None
+    if os.path.exists(paths):
+        with open(paths, 'rb') as file:
+            data = file.read(PATHS_HEADER.size)
+        if len(data) == PATHS_HEADER.size:
+            header = PATHS_HEADER.unpack(data)
+    stat = os.stat(fname)
+    if header is None or header[:3] != (PATHS, stat.st_size, stat.st_mtime_ns):
+        write_paths(fname)
+    out = {}
+    with open(paths, 'rb') as file:
+        _, _, _, codec, n_frames, n = PATHS_HEADER.unpack(file.read(PATHS_HEADER.size))
+        file.seek(PATHS_HEADER.size + 16*n_frames)
+        firsts = np.frombuffer(file.read(8*n), dtype="<u8").tolist()
+        columns = np.frombuffer(file.read(16*n), dtype="<u8").reshape(-1, 2).tolist()
+        for k in sorted(set(ids)):
+            if not 0 <= k < n:
+                continue
+            file.seek(columns[k][0])
+            data = file.read(columns[k][1])
+            pos = unpack_column(codec, data) if codec else np.frombuffer(data, dtype="<f8").reshape(-1, 2)
+            out[k] = (firsts[k], pos)
+    return out
+
+
+def tiers(serials, recent, stride=1):
+    """
+    Indices of the frames to keep out of frames numbered serials
+    (in the order they were written): every stride-th one of the
+    last recent frames, then every 2*stride-th one of the recent
+    frames before those, every 4*stride-th one of the 2*recent
+    before those, and so on, and the first and the newest
+    """
+    newest = serials[-1]
+    keep = []
+    for j, s in enumerate(serials):
+        age = newest - s
+        tier = 0 if age < recent else int(log2(age/recent)) + 1
+        if not j or j == len(serials)-1 or not s % (stride << tier):
+            keep.append(j)
+    return keep
+
+
+def read_track(fname):
+    """
+    Read the track saved next to a log with a size budget; returns
+    the number each frame of the log was written as, and every
+    particle's waypoints as (written frame number, x, y) by particle,
+    or None if there is no track or it does not match the log
+    """
+    if not os.path.exists(f"{fname}.track") or not is_trajectory(fname):
+        return None
+    with np.load(f"{fname}.track", allow_pickle=False) as data:
+        frames, particle, serial, pos = (data[k] for k in ("frames", "particle", "serial", "pos"))
+    if len(frames) != len(read_index(fname)):
+        return None
+    track = {}
+    for k, s, (x, y) in zip(particle.tolist(), serial.tolist(), pos.tolist()):
+        track.setdefault(k, []).append((s, x, y))
+    return frames.tolist(), track
+
+
+class TrajectoryWriter:
+    """
+    Trajectory log that stays open for a whole run;
+    frames are appended to an existing log, after dropping
+    the frames numbered above until if until is given.
+    With a budget (in bytes), older frames are thinned out
+    whenever the log, with its index and track, grows past
+    it, down to half of it, and every particle's path through
+    the maze cells is tracked with its loops cut out, so that
+    a path can always be traced even through dropped frames;
+    a log that cannot be kept within it stops taking frames
+    """
+    def __init__(self, fname, until=None, budget=0):
+        self.fname = fname
+        self.budget = budget
+        self.offsets, self.numbers = [], []
+        if is_trajectory(fname):
+            self.file = open(fname, 'r+b')
+            self.offsets = read_index(fname)
+            _, _, index = HEADER.unpack(self.file.read(HEADER.size))
+            end = index or _scan(self.file, HEADER.size, os.path.getsize(fname))[1]
+            for offset in self.offsets:
+                self.file.seek(offset)
+                self.numbers.append(FRAME.unpack(self.file.read(FRAME.size))[1])
+            while until is not None and self.numbers and self.numbers[-1] > until:
+                end = self.offsets.pop()
+                self.numbers.pop()
+
+            # drop the old index until the log is closed again,
+            # so that a crash leaves a log that can still be scanned
+            self.file.truncate(end)
+            self.file.seek(0)
+            self.file.write(HEADER.pack(MAGIC, 0, 0))
+            self.file.seek(end)
+        else:
+            self.file = open(fname, 'w+b')
+            self.file.write(HEADER.pack(MAGIC, 0, 0))
+        self.last = self.numbers[-1] if self.numbers else None
+        if budget:
+            self._load_track()
+
+    def _load_track(self):
+        """
+        Pick up the track of the log where it was left
+        """
+        self.serials = list(range(len(self.offsets)))
+        self.cells = np.zeros((0, 2), dtype=np.int64)
+        self.tracks = {}
+        self.points = 0
+        self.over = False
+        saved = read_track(self.fname) if self.offsets else None
+        if saved is None:
+            return 0
+        frames, track = saved
+        self.serials = frames[:len(self.offsets)]
+        last = self.serials[-1]
+        for k, points in track.items():
+            for s, x, y in points:
+                if s <= last:
+                    self._visit(k, (int(np.floor(x)), int(np.floor(y))), s, x, y)
+        self.cells = np.full((max(track, default=-1)+1, 2), np.iinfo(np.int64).min)
+        for k, (points, _) in self.tracks.items():
+            self.cells[k] = points[-1][0]
+        return 0
+
+    def _visit(self, k, cell, s, x, y):
+        """
+        Particle k entered cell at frame s; if it had been there
+        before, the loop it took since is cut out of its track
+        """
+        points, seen = self.tracks.setdefault(k, ([], {}))
+        j = seen.get(cell)
+        if j is None:
+            seen[cell] = len(points)
+            points.append((cell, s, x, y))
+            self.points += 1
+            return 0
+        for point in points[j+1:]:
+            del seen[point[0]]
+        self.points -= len(points) - j - 1
+        del points[j+1:]
+        return 0
+
+    def _follow(self, pos):
+        """
+        Update the tracks of the particles that changed cells
+        """
+        cells = np.floor(pos).astype(np.int64)
+        if len(self.cells) < len(cells):
+            new = np.full((len(cells)-len(self.cells), 2), np.iinfo(np.int64).min)
+            self.cells = np.concatenate((self.cells, new))
+        s = self.serials[-1]
+        for k in np.flatnonzero((cells != self.cells[:len(cells)]).any(axis=1)).tolist():
+            self._visit(k, tuple(cells[k].tolist()), s, *pos[k].tolist())
+        self.cells[:len(cells)] = cells
+        return 0
+
+    def _save_track(self):
+        """
+        Write the track next to the log, atomically
+        """
+        points = [(k, s, x, y) for k, (track, _) in sorted(self.tracks.items())
+                  for _, s, x, y in track]
+        particle, serial, x, y = (np.array(z) for z in zip(*points)) if points else ([], [], [], [])
+        tmp = f"{self.fname}.track.tmp"
+        with open(tmp, 'wb') as file:
+            np.savez(file, frames=np.array(self.serials, dtype=np.int64),
+                     particle=np.array(particle, dtype=np.int64),
+                     serial=np.array(serial, dtype=np.int64),
+                     pos=np.stack((np.array(x, dtype=np.float64), np.array(y, dtype=np.float64)),
+                                  axis=-1))
+        os.replace(tmp, f"{self.fname}.track")
+        return 0
+
+    def _extra(self, frames):
+        """
+        Bytes the frame index and the track take up
+        on top of frames frames of the log
+        """
+        # an index entry and a track entry per frame, and x, y,
+        # particle and frame per waypoint
+        return 16*frames + TRACK + 32*self.points
+
+    def _thin(self):
+        """
+        Drop older frames, tier by tier, until the log, its
+        index and its track take up at most half the budget;
+        once only one recent frame is left at full resolution,
+        the stride of every tier is doubled instead. If not even
+        the first and the newest frame fit in the budget along
+        with the track, the log is cut down to those two and
+        no more frames are logged
+        """
+        end = self.file.tell()
+        sizes = np.diff(self.offsets + [end]).tolist()
+        recent, stride = len(self.serials), 1
+        while True:
+            keep = tiers(self.serials, recent, stride)
+            used = HEADER.size + sum(sizes[j] for j in keep) + self._extra(len(keep))
+            if used <= self.budget/2 or len(keep) <= 2:
+                break
+            if recent > 1:
+                recent = max(recent//2, 1)
+            else:
+                stride *= 2
+        if used > self.budget:
+            self.over = True
+            print(f"\nW: The log no longer fits in its budget of {self.budget} bytes; "
+                  "no more frames are logged from here on")
+        if len(keep) == len(self.offsets):
+            return 0
+
+        # copy the frames that stay into a new log, and swap it in
+        tmp = f"{self.fname}.tmp"
+        offsets = []
+        with open(tmp, 'wb') as file:
+            file.write(HEADER.pack(MAGIC, 0, 0))
+            for j in keep:
+                offsets.append(file.tell())
+                self.file.seek(self.offsets[j])
+                file.write(self.file.read(sizes[j]))
+        self.file.close()
+        os.replace(tmp, self.fname)
+        self.file = open(self.fname, 'r+b')
+        self.file.seek(0, os.SEEK_END)
+        self.offsets = offsets
+        self.numbers = [self.numbers[j] for j in keep]
+        self.serials = [self.serials[j] for j in keep]
+        return self._save_track()
+
+    def write(self, t, i, pos, vel):
+        """
+        Append one frame, unless the log has been
+        stopped for not fitting in its budget
+        """
+        if self.budget and self.over:
+            return 0
+        pos = np.asarray(pos, dtype="<f8").reshape(-1, 2)
+        vel = np.asarray(vel, dtype="<f8").reshape(-1, 2)
+        self.offsets.append(self.file.tell())
+        self.numbers.append(i)
+        self.last = i
+        self.file.write(FRAME.pack(t, i, len(pos)))
+        self.file.write(pos.tobytes())
+        self.file.write(vel.tobytes())
+        if self.budget:
+            self.serials.append(self.serials[-1]+1 if self.serials else 0)
+            self._follow(pos)
+            if self.file.tell() + self._extra(len(self.offsets)) > self.budget:
+                self._thin()
+        return 0
+
+    def sync(self):
+        """
+        Get every frame written so far, and the track, onto disk
+        """
+        if self.budget:
+            self._save_track()
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return 0
+
+    def close(self):
+        """
+        Write the frame index and close the log
+        """
+        if self.file.closed:
+            return 0
+        if self.budget:
+            self._save_track()
+        index = self.file.tell()
+        self.file.write(np.array(self.offsets, dtype="<u8").tobytes())
+        self.file.seek(0)
+        self.file.write(HEADER.pack(MAGIC, len(self.offsets), index))
+        self.file.close()
+        return 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_log(fname, until=None, budget=0, compress=None):
+    """
+    Open a log for a run: a log that already exists keeps
+    its own format, and a new one is compressed with the
+    codec compress, if given. Only plain logs take a budget
+    """
+    if is_compressed(fname) or (compress and not is_trajectory(fname)):
+        if budget:
+            print("W: A compressed log is not kept within a budget")
+        return CompressedWriter(fname, until, compress or "zlib")
+    if compress:
+        print(f"W: {fname} is an uncompressed log; carrying on without compression")
+    return TrajectoryWriter(fname, until, budget)
+
+
+def export_text(fname, text_file):
+    """
+    Write a trajectory log out in the plain text log format
+    """
+    with open(text_file, 'w') as file:
+        file.write("Initialized system\n")
+        for t, i, pos, vel in read_frames(fname):
+            file.write(f"time: {t} i: {i}\n")
+            for p in pos.tolist():
+                file.write(f"pos {p[0]} {p[1]}\n")
+            for v in vel.tolist():
+                file.write(f"vel {v[0]} {v[1]}\n")
+    return 0
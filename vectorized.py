@@ -0,0 +1,391 @@
+"""
+NumPy engine for the EdMD simulation
+"""
+import numpy as np
+from maze import RIGHT, LEFT, TOP, BOTTOM
+from simulate import WALL, PAIR, exit_cells
+
+
+def _in_mask(walls, cell):
+    """
+    Which cells of an (n, 2) array the wall mask covers
+    """
+    i, j = cell[:, 0]+1, cell[:, 1]+1
+    return (0 <= i) & (i < walls.shape[0]) & (0 <= j) & (j < walls.shape[1])
+
+
+def _wall_bits(walls, cell):
+    """
+    Look up the wall mask of every cell in an (n, 2) array;
+    cells outside the mask have no walls
+    """
+    inside = _in_mask(walls, cell)
+    bits = np.zeros(len(cell), dtype=np.uint8)
+    bits[inside] = walls[cell[inside, 0]+1, cell[inside, 1]+1]
+    return bits
+
+
+def wall_times(pos, vel, r, walls, cell=None):
+    """
+    Time before each particle hits a wall of its cell, and
+    before it moves into the next cell, along each axis;
+    cell defaults to the cell each particle is in now. As in
+    EventQueue, crossings are not followed beyond the wall mask
+    """
+    cell = np.floor(pos).astype(np.intp) if cell is None else cell
+    side = np.where(vel > 0, [RIGHT, TOP], [LEFT, BOTTOM])
+    hit = (_wall_bits(walls, cell)[:, None] & side != 0) & (vel != 0)
+    off = pos - cell
+    edge = np.where(vel > 0, 1-off, off)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (np.where(hit, np.abs((edge-r)/np.abs(vel)), np.inf),
+                np.where((vel != 0) & _in_mask(walls, cell)[:, None],
+                         np.maximum(edge/np.abs(vel), 0), np.inf))
+
+
+def leaving(cell, exits):
+    """
+    Which of the cells in an (..., 2) array a disk heading down
+    leaves the maze from: the exit cells, and the row below the
+    maze, which can only be reached through them
+    """
+    return (np.isin(cell[..., 0], exits) & (cell[..., 1] == 0)) | (cell[..., 1] == -1)
+
+
+def pair_times(pos, vel, r, a, b):
+    """
+    Time before each pair (a[k], b[k]) of particles hit each other
+    """
+    dx, dv = pos[b]-pos[a], vel[b]-vel[a]
+    b_ij = dv[:, 0]*dx[:, 0] + dv[:, 1]*dx[:, 1]
+    dv_2 = dv[:, 0]**2 + dv[:, 1]**2
+    upsilon = b_ij**2 - dv_2*(dx[:, 0]**2 + dx[:, 1]**2 - 4*r**2)
+    hit = (b_ij < 0) & (upsilon > 0)
+    times = np.full(len(a), np.inf)
+    times[hit] = -(b_ij[hit] + np.sqrt(upsilon[hit]))/dv_2[hit]
+    return times
+
+
+class ArrayEvents:
+    """
+    Table of predicted events for the NumPy engine
+
+    Pair times are cached as absolute times in the upper triangle
+    of an (n, n) array, and only the rows and columns of particles
+    touched by an event are refreshed; soon and mate hold the
+    soonest time in every row and the column it is in, so the next
+    pair is found among n times rather than n*n. Wall times cost
+    O(n) in one batch, so they are simply recomputed for every event.
+    cell_list is accepted for symmetry with EventQueue, but all
+    pairs are evaluated either way; events counts the events
+    handed out. As in EventQueue, walls are only looked up for
+    the cell a particle is in, so the cell of every particle is
+    kept track of, and moved along when it is due to change.
+    Disks in an exit cell or in the row below the maze, either
+    now or by the next event, are checked for leaving the maze
+    before the next event; exit holds (time, particle) for the
+    first one that does, until that disk is knocked about before
+    its exit comes and the first disk then on its way out is
+    looked for instead
+    """
+    def __init__(self, p, v, r, walls, t=0, cell_list=False, state=None):
+        self.r = r
+        self.walls = walls
+        self.events = 0
+        self.exits = np.array([i for i, _ in exit_cells(walls)], dtype=np.intp)
+        self.exit = None
+        if state is None:
+            self.build(p, v, t)
+        else:
+            self.restore(state)
+
+    def build(self, p, v, t):
+        """
+        Predict all events from scratch
+        """
+        n = len(p)
+        self.cell = np.floor(p).astype(np.intp)
+        self.pairs = np.full((n, n), np.inf)
+        a, b = np.triu_indices(n, 1)
+        self.pairs[a, b] = t + pair_times(p, v, self.r, a, b)
+        self.soon, self.mate = np.full(n, np.inf), np.zeros(n, dtype=np.intp)
+        return self._refresh(np.arange(n))
+
+    def _refresh(self, rows):
+        """
+        Look for the soonest pair time in rows all over again
+        """
+        self.mate[rows] = np.argmin(self.pairs[rows], axis=1)
+        self.soon[rows] = self.pairs[rows, self.mate[rows]]
+        return 0
+
+    def state(self):
+        """
+        Everything the table knows, as arrays
+        """
+        return {"cell": self.cell, "pairs": self.pairs, "events": np.array(self.events),
+                "exit": np.array(self.exit or [], dtype=np.float64)}
+
+    def restore(self, state):
+        """
+        Bring back a table saved with state()
+        """
+        self.cell = state["cell"].astype(np.intp)
+        self.pairs = state["pairs"].copy()
+        self.events = int(state["events"])
+        self.exit = None
+        if len(state["exit"]):
+            self.exit = (state["exit"][0].item(), int(state["exit"][1]))
+        n = len(self.pairs)
+        self.soon, self.mate = np.full(n, np.inf), np.zeros(n, dtype=np.intp)
+        return self._refresh(np.arange(n))
+
+    def update(self, ks, p, v, t):
+        """
+        Re-predict the pair events of particles whose
+        position or velocity has just changed
+        """
+        n = len(p)
+        for k in ks:
+            self.cell[k] = np.floor(p[k])
+            times = t + pair_times(p, v, self.r, np.full(n, k), np.arange(n))
+            self.pairs[k, k+1:] = times[k+1:]
+            self.pairs[:k, k] = times[:k]
+
+        # rows of ks, and rows whose soonest pair was with one of
+        # them, are looked through again; the rest only need to
+        # see if a pair with one of ks now comes sooner
+        ks = np.fromiter(ks, dtype=np.intp)
+        if len(ks):
+            stale = np.isin(self.mate, ks)
+            stale[ks] = True
+            self._refresh(np.flatnonzero(stale))
+            rest = np.flatnonzero(~stale)
+            cols = self.pairs[np.ix_(rest, ks)]
+            j = np.argmin(cols, axis=1)
+            sooner = cols[np.arange(len(rest)), j] < self.soon[rest]
+            self.soon[rest[sooner]] = cols[np.arange(len(rest)), j][sooner]
+            self.mate[rest[sooner]] = ks[j[sooner]]
+
+        # an exit still to come is looked for again, right away,
+        # if its disk has been knocked about since; there is no
+        # next event to look up to, but a collision that stops
+        # the disk found here takes its exit back in turn
+        if self.exit is not None and self.exit[0] > t and self.exit[1] in ks:
+            self.exit = None
+            self._find_exit(np.floor(p).astype(np.intp), p, v, t, np.inf)
+        return 0
+
+    def add(self, ks, p, v, t):
+        """
+        Predict the pair events of particles that were
+        just added to the end of p or pushed
+        """
+        n, m = len(p), len(self.pairs)
+        if n > m:
+            pairs = np.full((n, n), np.inf)
+            pairs[:m, :m] = self.pairs
+            self.pairs = pairs
+            self.soon = np.concatenate((self.soon, np.full(n-m, np.inf)))
+            self.mate = np.concatenate((self.mate, np.zeros(n-m, dtype=np.intp)))
+            self.cell = np.concatenate((self.cell, np.floor(p[m:]).astype(np.intp)))
+        return self.update(ks, p, v, t)
+
+    def in_cells(self, cells):
+        """
+        Particles in any of cells, in order
+        """
+        return np.flatnonzero((self.cell[:, None] == np.array(cells)[None]).all(axis=2).any(axis=1)).tolist()
+
+    def put_back(self, time, event, t):
+        """
+        Nothing to do; next_event() leaves the table as it is
+        """
+        if event is not None:
+            self.events -= 1
+        return 0
+
+    def next_event(self, p, v, t):
+        """
+        Find the next event; returns its time from now
+        """
+        walls, cross = wall_times(p, v, self.r, self.walls, self.cell)
+        start = self.cell.copy() if self.exit is None else None
+        pair, a = np.inf, 0
+        if len(p) > 1:
+            a = int(np.argmin(self.soon))
+            pair = self.soon[a] - t
+        while True:
+            w_ix, c_ix = int(np.argmin(walls)), int(np.argmin(cross))
+            if cross.flat[c_ix] >= min(pair, walls.flat[w_ix]):
+                break
+
+            # moved into a new cell; see what walls lie ahead from there
+            k, l = c_ix//2, c_ix%2
+            self.cell[k, l] += 1 if v[k, l] > 0 else -1
+            walls[k], cross[k] = (x[0] for x in wall_times(p[k:k+1], v[k:k+1], self.r,
+                                                            self.walls, self.cell[k:k+1]))
+        if self.exit is None:
+            self._find_exit(start, p, v, t, min(pair, walls.flat[w_ix]))
+        if pair < walls.flat[w_ix]:
+            self.events += 1
+            return pair, (PAIR, a, int(self.mate[a]))
+        if walls.flat[w_ix] == np.inf:
+            return np.inf, None
+        self.events += 1
+        return walls.flat[w_ix], (WALL, w_ix//2, w_ix%2)
+
+    def _find_exit(self, start, p, v, t, until):
+        """
+        Look for a disk that is all the way out of the exit before
+        time t+until; start holds the cells of the disks at time t,
+        and cell those they will be in by then
+        """
+        ks = np.flatnonzero((leaving(start, self.exits) | leaving(self.cell, self.exits) |
+                             (self.cell[:, 1] < -1)) & (start[:, 1] >= -1) & (v[:, 1] < 0))
+        if not len(ks):
+            return 0
+        times = np.maximum((p[ks, 1]+self.r)/-v[ks, 1], 0)
+        j = int(np.argmin(times))
+        if times[j] <= until:
+            self.exit = (t+times[j].item(), int(ks[j]))
+        return 0
+
+
+def get_velocities(pos, vel, event):
+    """
+    Change velocities after event
+    """
+    kind, a, b = event
+    if kind == WALL:
+        vel[a, b] *= -1
+    else:
+        x_ij = pos[b]-pos[a]
+        x_ij /= np.sqrt(x_ij @ x_ij)
+        b_ij = (vel[b]-vel[a]) @ x_ij
+        vel[a] += x_ij*b_ij
+        vel[b] -= x_ij*b_ij
+    return vel
+
+
+def fix_delta(pos, vel, r, walls, l):
+    """
+    fix_delta() from simulate, for all disks at once;
+    returns which disks had to be bounced off a wall
+    """
+    m = 1-l
+    x, y = pos[:, l].copy(), pos[:, m].copy()
+    i, j = np.trunc(pos).astype(np.intp).T if not l else np.trunc(pos[:, ::-1]).astype(np.intp).T
+    bits = _wall_bits(walls, np.trunc(pos).astype(np.intp))
+    ahead, behind = (RIGHT, LEFT) if not l else (TOP, BOTTOM)
+    above, below = (TOP, BOTTOM) if not l else (RIGHT, LEFT)
+
+    # bounce back disks moving into a wall
+    near = (x < i+1) & (i+1 < x+r) & (vel[:, l] > 0)
+    flip = near & (bits & ahead != 0)
+    flip |= ~near & (x-r < i) & (i < x) & (vel[:, l] < 0) & (bits & behind != 0)
+    vel[flip, l] *= -1
+
+    # and push disks resting against a wall away from it
+    near = (y < j+1) & (j+1 < y+r) & (vel[:, m] == 0)
+    down = near & (bits & above != 0)
+    up = ~near & (y-r < j) & (j < y) & (vel[:, m] == 0) & (bits & below != 0)
+    pos[down, m] -= r
+    pos[up, m] += r
+    return flip | down | up
+
+
+def pull_apart(pos, vel, r, event):
+    """
+    pull_apart() from simulate, on arrays
+    """
+    _, a, b = event
+    shift = np.where(pos[a] > pos[b], r, -r)
+    pos[a] += shift
+    pos[b] -= shift
+    return pos, vel
+
+
+def move_all(p, v, r, walls, step):
+    """
+    Move every disk forward by one step;
+    returns the disks that fix_delta() had to touch
+    """
+    changed = np.zeros(len(p), dtype=bool)
+    for l in (0, 1):
+        changed |= fix_delta(p, v, r, walls, l)
+        p[:, l] += v[:, l]*step
+    return set(np.flatnonzero(changed).tolist())
+
+
+def simulate_step(p, v, r, table, walls, t, next_e, event, dt=0):
+    """
+    Run one step of simulation
+    """
+    if dt:
+        next_t = t + dt
+    else:
+        next_t = t + next_e
+    q = 0
+    while t+next_e <= next_t:
+        if q > 100:
+
+            # stuck here, skip to next event
+            step = max(dt, next_e)
+        else:
+            step = min(dt, next_e)
+        q += 1
+        t += step
+        changed = move_all(p, v, r, walls, step)
+        v = get_velocities(p, v, event)
+        if q > 100:
+            table.build(p, v, t)
+        else:
+            table.update(changed | set(event[1:] if event[0] == PAIR else event[1:2]), p, v, t)
+        next_e, event = table.next_event(p, v, t)
+        if next_e < 0 and event[0] == PAIR:
+            p, v = pull_apart(p, v, r, event)
+    remain_t = next_t - t
+    table.update(move_all(p, v, r, walls, remain_t), p, v, next_t)
+    t += remain_t
+    next_e -= remain_t
+    return p, v, next_e, event, t
+
+
+def jump_step(p, v, r, table, walls, t, next_e, event, dt):
+    """
+    Run one step of simulation by jumping from event to event;
+    moving every disk is a single array operation here, so all
+    of them are kept up to date instead of being moved lazily
+    """
+    next_t = t + dt
+    while t+next_e <= next_t:
+        t += next_e
+        changed = move_all(p, v, r, walls, next_e)
+        v = get_velocities(p, v, event)
+        table.update(changed | set(event[1:] if event[0] == PAIR else event[1:2]), p, v, t)
+        next_e, event = table.next_event(p, v, t)
+
+        # overlapping disks get pulled apart right away
+        # instead of colliding backwards in time
+        while next_e < 0 and event[0] == PAIR:
+            p, v = pull_apart(p, v, r, event)
+            table.update(set(event[1:]), p, v, t)
+            next_e, event = table.next_event(p, v, t)
+    table.update(move_all(p, v, r, walls, next_t-t), p, v, next_t)
+    next_e -= next_t - t
+    return p, v, next_e, event, next_t
+
+
+def to_state(x):
+    """
+    Pack positions or velocities into an (n, 2) array
+    """
+    return np.array(x, dtype=np.float64).reshape(-1, 2)
+
+
+def to_list(x):
+    """
+    Unpack an (n, 2) array into nested lists
+    """
+    return x.tolist()
@@ -3,19 +3,55 @@ Main class definition
 """
 import os
 import json
-from math import sqrt, pi
-from multiprocessing import Pool
-from maze import make_maze
+from math import sqrt, pi, isnan
+from itertools import islice
+from multiprocessing import Pool, cpu_count
+from maze import maze_walls
 from initialize import initial_pos, initial_vel
-from simulate import run_simulation, simulation_with_fan
-from plot import save_snap, make_video, plot_trace_path
+from simulate import run_simulation, simulation_with_fan, Profiler
+from domains import run_domains
+from trajectory import read_frames, read_paths, read_track, last_frame, export_text
+from compressed import is_compressed, plan_chunks, read_chunk
+from checkpoint import Checkpointer, load_checkpoint, resume_state
+
+
+def _snap_chunk(logfile, offset, codec, picks, radius, grid, snapdir, with_arrows):
+    """
+    Pool helper; decode one chunk of a compressed log
+    and save snapshots of the frames picked from it;
+    grid is None in a pool started with use_maze()
+    """
+    from plot import save_snap
+    frames = read_chunk(logfile, offset, codec)
+    for j in picks:
+        _, i, p, v = frames[j]
+        save_snap(i, p.tolist(), v.tolist(), radius, grid, snapdir, with_arrows)
+    return 0
 
 
 class MazeDiffusion:
     def __init__(self, n=10, rows=10, cols=10, from_file=None, **kwargs):
         self.n = 0
+        self.cell_list = kwargs.get("cell_list", False)
+        self.engine = kwargs.get("engine", "list")
+        self.edmd = kwargs.get("edmd", False)
+        self.live_snaps = kwargs.get("live_snaps", False)
+        self.save_pngs = kwargs.get("save_pngs", True)
+        self.lattice = kwargs.get("lattice", False)
+        self.domains = kwargs.get("domains", 0)
+        self.checkpoint = kwargs.get("checkpoint", None)
+        self.checkpoint_every = kwargs.get("checkpoint_every", 100)
+        self.profile = kwargs.get("profile", None)
+        self.log_budget = kwargs.get("log_budget", 0)
+        self.compress = kwargs.get("compress", None)
+        self.events = 0
+        self.exit_time, self.exit_particle = None, None
+        self.restart = None
+        self.walls = None
         if from_file:
             self.file_import(from_file)
+        if kwargs.get("resume", None):
+            self.file_resume(kwargs["resume"])
         if not self.n:
             self.n = n
             self.height = rows
@@ -35,7 +71,7 @@ class MazeDiffusion:
             self.fan_speed = kwargs.get("pressure_factor", 0)
             self.export_file = kwargs.get("to_file", None)
             self.initialize()
-        if self.fan_speed:
+        if self.fan_speed and not self.restart:
             self.orig_n = n
 
     def initialize(self):
@@ -49,7 +85,7 @@ class MazeDiffusion:
             self.radius = sqrt(.3/self.n/pi)
         newlog = True
         if not self.pos:
-            self.pos = initial_pos(self.n, self.radius)
+            self.pos = initial_pos(self.n, self.radius, self.lattice)
             self.pos = [[p[0], p[1] + self.height] for p in self.pos]
         else:
             self.n = 0
@@ -62,14 +98,13 @@ class MazeDiffusion:
             self.import_vel()
             newlog = False
         if not self.grid:
-            self.grid = make_maze(self.width, self.height)
+            self.grid, self.walls = maze_walls(self.width, self.height)
         else:
             self.import_grid()
         if newlog:
-            if os.path.exists(self.logfile):
-                os.remove(self.logfile)
-            with open(self.logfile, 'w') as file:
-                file.write("Initialized system\n")
+            for fname in (self.logfile, f"{self.logfile}.track", f"{self.logfile}.paths"):
+                if os.path.exists(fname):
+                    os.remove(fname)
         print("I: Initializing system...Done")
         return 0
 
@@ -88,6 +123,22 @@ class MazeDiffusion:
         print("I: Importing object from file...Done")
         return 0
 
+    def file_resume(self, fname):
+        """
+        Pick up an interrupted run from a checkpoint
+        """
+        print("I: Resuming from checkpoint...\r", end='', flush=True)
+        meta, arrays = load_checkpoint(fname)
+        for prop, val in meta["attrs"].items():
+            self.__dict__[prop] = val
+        self.grid = [tuple(map(tuple, edge)) for edge in arrays["edges"].tolist()]
+        self.restart = resume_state(meta, arrays)
+        self.walls = self.restart["walls"]
+        self.pos, self.vel = self.restart["pos"].tolist(), self.restart["vel"].tolist()
+        self.n = self.restart["n"]
+        print(f"I: Resuming from checkpoint...Done (step {self.restart['i']}, {self.restart['t']:.5f} s)")
+        return 0
+
     def file_export(self, fname):
         """
         Export object instance to file
@@ -100,7 +151,7 @@ class MazeDiffusion:
             print("W: Exporting object instance to file...     (overwriting existing file)\r",
                   end='', flush=True)
         with open(fname, 'w') as file:
-            json.dump(self.__dict__, file)
+            json.dump({k: x for k, x in self.__dict__.items() if k != "walls"}, file)
         print("I: Exporting object instance to file...Done")
         return 0
 
@@ -158,36 +209,81 @@ class MazeDiffusion:
         print("I: Importing maze wall coordinates...Done")
         return 0
 
-    def make_snaps(self):
+    def make_snaps(self, start=0, stop=None, step=1):
         """
-        Plot snapshots of simulation
+        Plot snapshots of simulation;
+        start, stop and step pick frames from the log
         """
-        with open(self.logfile, 'r') as file:
-            t, i, p, v = -1, 0, [], []
-            with Pool() as builder:
-                print("I: Creating simulation snapshots")
-                for line in file.readlines():
-                    if line.startswith("time"):
-                        if t >= 0:
-                            builder.apply_async(save_snap,
-                                                args=(i, p, v,self.radius, self.grid,
-                                                      self.snapdir, self.with_arrows))
-                            t, i, p, v = 0, 0, [], []
-                        _, t, _, i = line.split(' ')
-                        t, i = float(t), int(i)
-                    elif line.startswith("pos"):
-                        p.append([float(x) for x in line.rstrip().split(' ')[1:]])
-                    elif line.startswith("vel"):
-                        v.append([float(x) for x in line.rstrip().split(' ')[1:]])
-                builder.close()
-                builder.join()
-            save_snap(i+1, p, v, self.radius, self.grid,
-                      self.snapdir, self.with_arrows, e_x=max(x[1][0] for x in self.grid), e_y=0)
+        if not self.save_pngs:
+            return self.stream_snaps(start, stop, step)
+        from plot import save_snap, make_video, use_maze
+        t, i, p, v = -1, 0, [], []
+
+        # each worker gets the maze once, not with every frame
+        with Pool(initializer=use_maze, initargs=(self.grid,)) as builder:
+            print("I: Creating simulation snapshots")
+            if is_compressed(self.logfile):
+
+                # each worker decodes a chunk of the log by itself
+                codec, plan = plan_chunks(self.logfile, start, stop, step)
+                if plan:
+                    offset, picks = plan[-1]
+                    t, i, p, v = read_chunk(self.logfile, offset, codec)[picks.pop()]
+                    p, v = p.tolist(), v.tolist()
+                for offset, picks in plan:
+                    if picks:
+                        builder.apply_async(_snap_chunk,
+                                            args=(self.logfile, offset, codec, picks, self.radius,
+                                                  None, self.snapdir, self.with_arrows))
+            else:
+                for frame in read_frames(self.logfile, start, stop, step):
+                    if t >= 0:
+                        builder.apply_async(save_snap,
+                                            args=(i, p, v, self.radius, None,
+                                                  self.snapdir, self.with_arrows))
+                    t, i, p, v = frame[0], frame[1], frame[2].tolist(), frame[3].tolist()
+            builder.close()
+            builder.join()
+        save_snap(i+1, p, v, self.radius, self.grid,
+                  self.snapdir, self.with_arrows, e_x=max(x[1][0] for x in self.grid), e_y=0)
         print("I: Merging snapshots to create final video...\r", end='', flush=True)
         make_video(self.snapdir)
         print("I: Merging snapshots to create final video...Done")
         return 0
 
+    def stream_snaps(self, start=0, stop=None, step=1):
+        """
+        Draw snapshots of simulation straight into the video,
+        without saving them as PNGs first
+        """
+        from plot import snap_frame, VideoStream, use_maze
+        os.makedirs(self.snapdir, exist_ok=True)
+        video = VideoStream(os.path.join(self.snapdir, "final_simulation.avi"))
+        frames = read_frames(self.logfile, start, stop, step)
+        t, i, p, v = -1, 0, [], []
+        print("I: Drawing simulation video...\r", end='', flush=True)
+        with Pool(initializer=use_maze, initargs=(self.grid,)) as builder:
+
+            # frames are drawn a batch at a time, so that only
+            # a few of them are held in memory at once; the
+            # workers already have the maze, see use_maze()
+            while True:
+                batch = []
+                for frame in islice(frames, 4*cpu_count()):
+                    if t >= 0:
+                        batch.append((i, p, v, self.radius, None,
+                                      self.snapdir, self.with_arrows, False))
+                    t, i, p, v = frame[0], frame[1], frame[2].tolist(), frame[3].tolist()
+                if not batch:
+                    break
+                for img in builder.starmap(snap_frame, batch):
+                    video.write(img)
+        video.write(snap_frame(i+1, p, v, self.radius, self.grid, self.snapdir, self.with_arrows,
+                               False, e_x=max(x[1][0] for x in self.grid), e_y=0))
+        video.release()
+        print("I: Drawing simulation video...Done")
+        return 0
+
     def simulate(self, num_steps):
         """
         Run simulation on the system instance
@@ -195,20 +291,93 @@ class MazeDiffusion:
         if not self.radius:
             print("I: Please initialize the positions and velocities first.")
             return 0
-        if self.fan_speed:
-            time, pos, vel, n, i = simulation_with_fan(self.n, self.orig_n, self.pos, self.vel,
-                                                       self.radius, self.grid, int(num_steps),
-                                                       self.fan_speed, self.height, self.dt,
-                                                       self.stepsize, self.snapdir, self.logfile)
-            self.n = n
-        else:
-            time, pos, vel, i = run_simulation(self.n, self.pos, self.vel, self.radius, self.grid,
-                                               int(num_steps), self.dt, self.stepsize, self.snapdir,
-                                               self.logfile)
+        render, video = None, None
+        if self.live_snaps:
+            # plotting is only loaded for runs that draw something
+            from plot import save_snap, snap_frame, make_video, VideoStream
+            from pipeline import SnapshotPipeline
+            if not self.save_pngs:
+                os.makedirs(self.snapdir, exist_ok=True)
+                video = VideoStream(os.path.join(self.snapdir, "final_simulation.avi"))
+            render = SnapshotPipeline(self.radius, self.grid, self.snapdir, self.with_arrows,
+                                      video=video, save_png=self.save_pngs)
+        if self.fan_speed and self.domains:
+            print("W: Domain decomposition does not support a pressure fan; running in one process")
+        if self.cell_list and self.engine == "numpy":
+            print("W: The numpy engine keeps the full table of pair times; ignoring --cell_list")
+
+        # a resumed run carries on with the steps it was started with
+        resume, self.restart = self.restart, None
+        if resume:
+            num_steps = resume["steps"]
+        checkpoint = None
+        if self.checkpoint:
+            if self.domains and not self.fan_speed:
+                print("W: Checkpoints are not written in domain decomposition mode")
+            attrs = {k: x for k, x in self.__dict__.items() if k not in ("pos", "vel", "grid", "walls")}
+            checkpoint = Checkpointer(self.checkpoint, self.checkpoint_every, attrs, self.grid,
+                                      int(num_steps), self.walls)
+        profile = None
+        if self.profile:
+            if self.domains and not self.fan_speed:
+                print("W: The simulation is not profiled in domain decomposition mode")
+            else:
+                profile = Profiler()
+        try:
+            if self.fan_speed:
+                time, pos, vel, n, out, events = simulation_with_fan(self.n, self.orig_n, self.pos,
+                                                                     self.vel, self.radius, self.grid,
+                                                                     int(num_steps), self.fan_speed,
+                                                                     self.height, self.dt, self.stepsize,
+                                                                     self.snapdir, self.logfile,
+                                                                     self.cell_list, self.engine,
+                                                                     self.edmd, render, checkpoint,
+                                                                     resume, profile, self.log_budget,
+                                                                     self.compress, self.walls)
+                self.n = n
+            elif self.domains:
+                time, pos, vel, out, events = run_domains(self.n, self.pos, self.vel, self.radius,
+                                                          self.grid, int(num_steps), self.dt,
+                                                          self.stepsize, self.snapdir, self.logfile,
+                                                          self.domains, render, self.log_budget,
+                                                          self.compress, self.walls)
+            else:
+                time, pos, vel, out, events = run_simulation(self.n, self.pos, self.vel, self.radius,
+                                                             self.grid, int(num_steps), self.dt,
+                                                             self.stepsize, self.snapdir, self.logfile,
+                                                             self.cell_list, self.engine, self.edmd,
+                                                             render, checkpoint, resume, profile,
+                                                             self.log_budget, self.compress, self.walls)
+        finally:
+            if profile:
+                profile.detach()
+            if render:
+                print("I: Waiting for the remaining snapshots...\r", end='', flush=True)
+                render.close()
+                print("I: Waiting for the remaining snapshots...Done")
+        if video:
+            video.write(snap_frame(render.last+1, pos, vel, self.radius, self.grid, self.snapdir,
+                                   self.with_arrows, False,
+                                   e_x=max(x[1][0] for x in self.grid), e_y=0))
+            video.release()
+        elif render:
+            save_snap(render.last+1, pos, vel, self.radius, self.grid, self.snapdir,
+                      self.with_arrows, e_x=max(x[1][0] for x in self.grid), e_y=0)
+            print("I: Merging snapshots to create final video...\r", end='', flush=True)
+            make_video(self.snapdir)
+            print("I: Merging snapshots to create final video...Done")
+        if profile:
+            data = profile.report(self.profile, engine=self.engine, edmd=self.edmd,
+                                  cell_list=self.cell_list, particles=self.n,
+                                  steps=int(num_steps), simulated_time=time)
+            print(f"I: {data['events_per_s']:.0f} events/s; profile saved in {self.profile}")
+        self.indicator = int(out is not None)
+        if out:
+            self.exit_time, self.exit_particle = self.duration + out[0], out[1]
         self.duration += time
+        self.events += events
         self.pos = pos
         self.vel = vel
-        self.indicator = i
         if self.export_file:
             self.file_export(self.export_file)
         return 0
@@ -221,21 +390,48 @@ class MazeDiffusion:
         if not self.indicator:
             print("E: Failed to trace path; no particle seems to have exited the maze")
             return 1
-        with open(self.logfile, 'r') as file:
-            data, tmp = [], []
-            for line in file.readlines()[1:]:
-                if line.startswith("time"):
-                    if tmp:
-                        data.append(tmp)
-                    tmp = []
-                elif line.startswith("pos"):
-                    tmp.append([float(x) for x in line.split(' ')[1:]])
-            data.append(tmp)
-        if len(data) <= 1:
+        frame = last_frame(self.logfile) if os.path.exists(self.logfile) else None
+        if frame is None or not frame[1]:
             print("E: Simulation log seems to be missing; cannot create trace path")
             return 1
-        plot_trace_path(data, self.width, self.radius, self.grid, self.snapdir)
-        print("I: Tracing the path of the exiting particle...Done")
+
+        # the simulation tells which particle left; for older runs,
+        # it is the lowest one below the exit
+        k = self.exit_particle
+        if k is None:
+            last = frame[2].tolist()
+            low = min(p[1] for p in last if self.width-2 < p[0] < self.width)
+            k = last.index([x for x in last if x[1] == low][0])
+
+        # only the column of that particle is read; it starts at the frame it
+        # was added in, and a log kept within a budget has a track of the
+        # frames it dropped
+        first, column = read_paths(self.logfile, [k])[k]
+        column = column.tolist()
+        path = [x for x in column if not isnan(x[0])]
+        track = read_track(self.logfile)
+        if track:
+            serials, points = track
+            path = {s: x for s, x in zip(serials[first:], column) if not isnan(x[0])}
+            for s, x, y in points.get(k, []):
+                path.setdefault(s, [x, y])
+            path = [path[s] for s in sorted(path)]
+        from plot import plot_trace_path
+        plot_trace_path(path, self.radius, self.grid, self.snapdir)
+        if self.exit_time is not None:
+            print(f"I: Tracing the path of the exiting particle...Done (particle {k}, "
+                  f"out at {self.exit_time:.5f} s)")
+        else:
+            print("I: Tracing the path of the exiting particle...Done")
+        return 0
+
+    def export_log(self, log_file):
+        """
+        Export simulation log in plain text format
+        """
+        print("I: Exporting simulation log as text...\r", end='', flush=True)
+        export_text(self.logfile, log_file)
+        print("I: Exporting simulation log as text...Done")
         return 0
 
     def save_maze(self, grid_file):
@@ -287,5 +483,7 @@ class MazeDiffusion:
             factor = "No"
         print(f"    Pressurized entry point: {factor}")
         print(f"    MD Simulation has been run for {self.duration:.5f} seconds")
+        if self.exit_time is not None:
+            print(f"    Particle {self.exit_particle} solved the maze at {self.exit_time:.5f} seconds")
         avg_vel = sqrt((sum(sqrt(v[0]**2+v[1]**2) for v in self.vel)/len(self.vel))**2)
         return f"    RMS velocity of particles: {avg_vel}"